@@ -8,9 +8,12 @@
 #include <unordered_map>
 #include <vector>
 #include <functional>
+#include <algorithm>
 #include <cmath>
 #include <random>
 #include "cnpy.h"
+#include "path_lookup.hpp"
+#include "times_matrix.hpp"
 
 using namespace std;
 
@@ -114,6 +117,61 @@ namespace mod
             long *data;
     };
 
+    class CumulativeArray
+    {
+        // Running total of the frequency tensor in C order, as written by
+        // sparse_freqs.save_cumulative
+        public:
+            cnpy::NpyArray arr;
+
+            CumulativeArray() {}
+
+            CumulativeArray(cnpy::NpyArray arr) : arr(arr)
+            {
+                data = this->arr.data<long>();
+            }
+
+            long compute_index(int interval, int day, int pickup,
+                    int dropoff) const
+            {
+                long D1 = arr.shape[1], D2 = arr.shape[2], D3 = arr.shape[3];
+                return interval * D1 * D2 * D3 + day * D2 * D3
+                    + pickup * D3 + dropoff;
+            }
+
+            Demand compute_coords(long index) const
+            {
+                long D1 = arr.shape[1], D2 = arr.shape[2], D3 = arr.shape[3];
+                int drop = index % D3;
+                int pick = (index / D3) % D2;
+                int day = (index / (D2 * D3)) % D1;
+                int inter = index / (D1 * D2 * D3);
+                return Demand(inter, day, pick, drop);
+            }
+
+            long get(long index) const
+            {
+                return data[index];
+            }
+
+            // Total of the cells from first to last, both included
+            long total(long first, long last) const
+            {
+                return get(last) - (first > 0 ? get(first - 1) : 0);
+            }
+
+            // Index of the cell from first to last holding the given amount,
+            // counted from the start of the tensor, with a binary search
+            long search(long amount, long first, long last) const
+            {
+                return upper_bound(data + first, data + last + 1, amount)
+                    - data;
+            }
+
+        private:
+            long *data;
+    };
+
     class Time
     {
         public:
@@ -204,9 +262,12 @@ namespace mod
             vector<int> station_ids;
             unordered_map<int, GeoLocation> stations_map;
             vector<vector<double>> times;
+            TimesMatrix *times_matrix = nullptr;
             unordered_map<int, unordered_map<int, vector<int>>> paths;
             unordered_map<int, int> freqs;
             MultiArray *freqs_ma;
+            CumulativeArray *cum_freqs_ma = nullptr;
+            PathLookup *path_lookup = nullptr;
             vector<GeoLocation> nodes;
 
         public:
@@ -260,6 +321,23 @@ namespace mod
                 freqs_ma = new MultiArray(arr);
             }
 
+            // A running total loaded before is freed
+            void load_cum_freqs(string fn_cum_freqs)
+            {
+                delete cum_freqs_ma;
+                cum_freqs_ma = nullptr;
+                cnpy::NpyArray arr = cnpy::npy_load(fn_cum_freqs);
+                cum_freqs_ma = new CumulativeArray(arr);
+            }
+
+            // Rebuilds the paths from a predecessor matrix instead of the
+            // paths file, keeping up to cache_size of the recently used ones
+            void load_preds(string fn_preds, size_t cache_size = 0)
+            {
+                delete path_lookup;
+                path_lookup = new PathLookup(fn_preds, cache_size);
+            }
+
             void load_nodes(string fn_nodes)
             {
                 double lat, lon;
@@ -322,8 +400,18 @@ namespace mod
                 load_times(fn_times);
             }
 
+            // A .npy matrix is memory mapped, anything else is read as a
+            // times.csv text file. A matrix mapped before is unmapped
             void load_times(string fn_times)
             {
+                delete times_matrix;
+                times_matrix = nullptr;
+                size_t n = fn_times.size();
+                if (n >= 4 and fn_times.compare(n - 4, 4, ".npy") == 0)
+                {
+                    times_matrix = new TimesMatrix(fn_times);
+                    return;
+                }
                 ifstream data(fn_times);
                 string line;
                 getline(data, line);
@@ -376,13 +464,26 @@ namespace mod
             {
                 // returns true if there is a path, false if there isn't
                 double time_edge = 0;
-                if (paths.count(start) > 0 and paths[start].count(end) > 0)
+                bool found;
+                if (path_lookup != nullptr)
+                {
+                    found = path_lookup->get_path(start, end, path);
+                }
+                else
+                {
+                    found = paths.count(start) > 0
+                        and paths[start].count(end) > 0;
+                    if (found)
+                    {
+                        path = paths[start][end];
+                    }
+                }
+                if (found)
                 {
-                    path = paths[start][end];
                     inter_times.push_back(time_edge);
                     for (size_t i = 0; i < path.size() - 1; i++)
                     {
-                        time_edge = times[path[i]][path[i + 1]];
+                        time_edge = get_travel_time(path[i], path[i + 1]);
                         inter_times.push_back(time_edge);
                     }
                     return true;
@@ -399,11 +500,15 @@ namespace mod
                 GeoLocation gl(lat, lon);
                 int closest_station = get_station(gl);
                 double dist = get_station(closest_station).distance(gl);
-                return dist + times[closest_station][station];
+                return dist + get_travel_time(closest_station, station);
             }
 
             double get_travel_time(int station1, int station2) const
             {
+                if (times_matrix != nullptr)
+                {
+                    return times_matrix->get(station1, station2);
+                }
                 return times[station1][station2];
             }
 
@@ -464,6 +569,11 @@ namespace mod
 
             bool sample(int num, Time st, Time end, vector<Demand>& dems)
             {
+                if (cum_freqs_ma != nullptr)
+                {
+                    return sample_cumulative(num, st, end, dems);
+                }
+
                 int st_int = st.get_interval();
                 int end_int = end.get_interval();
                 int n_stations = freqs_ma->arr.shape[2];
@@ -519,6 +629,66 @@ namespace mod
                     return false;
                 }
             }
+
+            // Same as sample, but with the running totals loaded by
+            // load_cum_freqs. The days of an interval are contiguous in the
+            // tensor, so the window is one block per interval whose total is
+            // a subtraction, and each sample is a binary search
+            bool sample_cumulative(int num, Time st, Time end,
+                    vector<Demand>& dems)
+            {
+                int st_int = st.get_interval();
+                int end_int = end.get_interval();
+                int n_stations = cum_freqs_ma->arr.shape[2];
+                long block_size = (long) (end.day - st.day + 1)
+                    * n_stations * n_stations;
+                vector<long> firsts;
+                vector<long> block_sums;
+                long freq_sum = 0;
+
+                if (block_size <= 0)
+                {
+                    return false;
+                }
+
+                for (int inter = st_int; inter <= end_int; inter++)
+                {
+                    long first = cum_freqs_ma->compute_index(
+                            inter, st.day, 0, 0);
+                    freq_sum += cum_freqs_ma->total(
+                            first, first + block_size - 1);
+                    firsts.push_back(first);
+                    block_sums.push_back(freq_sum);
+                }
+
+                if (freq_sum <= 0)
+                {
+                    return false;
+                }
+
+                if (num > freq_sum / 52) {
+                    num = freq_sum / 52;
+                }
+
+                for (int i = 0; i < num; i++)
+                {
+                    double rnd = (double) rand() / ((double) RAND_MAX + 1);
+                    long r = (long) (rnd * freq_sum);
+                    size_t b = upper_bound(block_sums.begin(),
+                            block_sums.end(), r) - block_sums.begin();
+                    long before = b > 0 ? block_sums[b - 1] : 0;
+                    long first = firsts[b];
+                    long offset = first > 0 ? cum_freqs_ma->get(first - 1) : 0;
+                    long index = cum_freqs_ma->search(
+                            offset + r - before, first,
+                            first + block_size - 1);
+                    Demand dem = cum_freqs_ma->compute_coords(index);
+                    dems.push_back(Demand(dem.tau, dem.day,
+                                station_ids[dem.pickup],
+                                station_ids[dem.dropoff]));
+                }
+                return true;
+            }
     };
 };
 
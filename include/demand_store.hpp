@@ -0,0 +1,152 @@
+
+#ifndef DEMAND_STORE_HPP
+#define DEMAND_STORE_HPP
+
+#include <cstdint>
+#include <cstring>
+#include <string>
+#include <stdexcept>
+#include <algorithm>
+#include "mapped_file.hpp"
+
+using namespace std;
+
+namespace mod
+{
+
+    // Fixed width record of scripts/demand_store.py, little endian
+    struct DemandRecord
+    {
+        int64_t pickup_epoch, dropoff_epoch;
+        int32_t pickup_station, dropoff_station;
+        double pickup_lon, pickup_lat, dropoff_lon, dropoff_lat;
+    };
+
+    static_assert(sizeof(DemandRecord) == 56,
+            "DemandRecord must match demand_store.record_dtype");
+
+    struct DemandStoreHeader
+    {
+        char magic[8];
+        uint32_t version, record_size;
+        int64_t n_records, reserved;
+    };
+
+    struct DemandIndexHeader
+    {
+        char magic[8];
+        uint32_t version, step_secs;
+        int64_t first_day, n_days, steps_per_day;
+    };
+
+    // Records of a range of a demand store, sorted by pickup time
+    class DemandRange
+    {
+        public:
+            const DemandRecord *first, *last;
+
+            DemandRange() : first(nullptr), last(nullptr) {}
+            DemandRange(const DemandRecord *first, const DemandRecord *last)
+                : first(first), last(last)
+            {
+            }
+
+            const DemandRecord* begin() const { return first; }
+            const DemandRecord* end() const { return last; }
+            size_t size() const { return last - first; }
+            bool empty() const { return first == last; }
+    };
+
+    // Memory mapped reader of the demand store written by
+    // scripts/demand_store.py. The records of step s of day d are at
+    // offsets[d * steps_per_day + s] up to the next offset
+    class DemandStore
+    {
+        public:
+            DemandStore() {}
+
+            DemandStore(string fn_demands)
+            {
+                load(fn_demands);
+            }
+
+            void load(string fn_demands)
+            {
+                data.open(fn_demands);
+                index.open(fn_demands + ".idx");
+                if (data.size < sizeof(DemandStoreHeader)
+                        or index.size < sizeof(DemandIndexHeader))
+                {
+                    throw runtime_error(fn_demands + " is too short");
+                }
+                const DemandStoreHeader *dh =
+                    data.at<DemandStoreHeader>(0);
+                const DemandIndexHeader *ih =
+                    index.at<DemandIndexHeader>(0);
+                if (memcmp(dh->magic, "MODDEMND", 8) != 0
+                        or memcmp(ih->magic, "MODDEMIX", 8) != 0
+                        or dh->record_size != sizeof(DemandRecord))
+                {
+                    throw runtime_error(fn_demands + " is not a demand store");
+                }
+                n_records = dh->n_records;
+                first_day = ih->first_day;
+                n_days = ih->n_days;
+                steps_per_day = ih->steps_per_day;
+                step_secs = ih->step_secs;
+                records = data.at<DemandRecord>(sizeof(DemandStoreHeader));
+                day_starts = index.at<int64_t>(sizeof(DemandIndexHeader));
+                offsets = day_starts + n_days;
+            }
+
+            // Records of the steps first_step to last_step, both included,
+            // of a day given as days since 1970-01-01
+            DemandRange steps(long day, long first_step, long last_step) const
+            {
+                long d = day - first_day;
+                first_step = max(first_step, 0L);
+                last_step = min(last_step, steps_per_day - 1);
+                if (d < 0 or d >= n_days or last_step < first_step)
+                {
+                    return DemandRange();
+                }
+                long base = d * steps_per_day;
+                return DemandRange(records + offsets[base + first_step],
+                        records + offsets[base + last_step + 1]);
+            }
+
+            DemandRange day(long day) const
+            {
+                return steps(day, 0, steps_per_day - 1);
+            }
+
+            // Records from secs_min up to, but not including, secs_max
+            // seconds after the local midnight of the day, a step at a time
+            DemandRange between(long day, long secs_min, long secs_max) const
+            {
+                if (secs_max <= secs_min)
+                {
+                    return DemandRange();
+                }
+                return steps(day, secs_min / step_secs,
+                        (secs_max - 1) / step_secs);
+            }
+
+            // Epoch seconds of the local midnight of a day
+            long day_start(long day) const
+            {
+                return day_starts[day - first_day];
+            }
+
+            long n_records = 0, first_day = 0, n_days = 0;
+            long steps_per_day = 0, step_secs = 0;
+
+        private:
+            MappedFile data, index;
+            const DemandRecord *records = nullptr;
+            const int64_t *day_starts = nullptr, *offsets = nullptr;
+    };
+
+}
+
+#endif
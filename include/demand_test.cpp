@@ -2,6 +2,7 @@
 #include <iostream>
 #include <random>
 #include "demand.hpp"
+#include "demand_store.hpp"
 
 using namespace std;
 
@@ -41,6 +42,64 @@ void test_sample(mod::DemandLookup& dl)
                 << "/" << num << std::endl;
 }
 
+void test_sample_cumulative(mod::DemandLookup& dl)
+{
+    cout << "================ Cumulative Sample Test ================";
+    cout << endl;
+    dl.load_cum_freqs("../data/out/freqs_cumsum.npy");
+    test_sample(dl);
+}
+
+void test_demand_store()
+{
+    cout << "================== Demand Store Test ==================";
+    cout << endl;
+    mod::DemandStore store("../data/out/demands.bin");
+    long first_day = store.first_day;
+    mod::DemandRange dems = store.between(first_day, 0, 1800);
+    cout << "Records: " << store.n_records << endl;
+    cout << "Days: " << store.n_days << endl;
+    cout << "First 30 minutes of day " << first_day << ": " << dems.size()
+        << endl;
+    for (const mod::DemandRecord& dem : dems)
+    {
+        cout << "\t" << dem.pickup_epoch << " " << dem.pickup_station
+            << " -> " << dem.dropoff_station << endl;
+    }
+}
+
+void test_pred_path_lookup()
+{
+    cout << "================ Predecessor Path Test ================";
+    cout << endl;
+    mod::PathLookup lookup("../data/out/preds.npy", 1024);
+    vector<int> path;
+    if (lookup.get_path(0, 10, path))
+    {
+        cout << "Path: " << endl;
+        for (size_t i = 0; i < path.size(); i++)
+        {
+            cout << "\t" << path[i] << endl;
+        }
+        cout << endl;
+    }
+    else
+    {
+        cout << "No Path Found!!!" << endl;
+    }
+}
+
+void test_times_matrix()
+{
+    cout << "================== Times Matrix Test ==================";
+    cout << endl;
+    mod::DemandLookup csv_dl, npy_dl;
+    csv_dl.load_times("../data/out/times.csv");
+    npy_dl.load_times("../data/out/times.npy");
+    cout << "Text: " << csv_dl.get_travel_time(0, 10) << endl;
+    cout << "Matrix: " << npy_dl.get_travel_time(0, 10) << endl;
+}
+
 void test_path_lookup(mod::DemandLookup& dl)
 {
     cout << "==================== Path Lookup Test ====================";
@@ -91,6 +150,10 @@ int main() {
     //         "../data/freqs.csv");
     // test_query(dl);
     test_sample(dl);
+    test_sample_cumulative(dl);
+    test_demand_store();
+    test_pred_path_lookup();
+    test_times_matrix();
     // test_path_lookup(dl);
     // test_request_freqs(dl);
 }
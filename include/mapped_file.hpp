@@ -0,0 +1,88 @@
+
+#ifndef MAPPED_FILE_HPP
+#define MAPPED_FILE_HPP
+
+#include <string>
+#include <stdexcept>
+#include <cstddef>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+using namespace std;
+
+namespace mod
+{
+
+    // Read-only memory mapping of a whole file, unmapped when destroyed
+    class MappedFile
+    {
+        public:
+            MappedFile() {}
+
+            MappedFile(string fn)
+            {
+                open(fn);
+            }
+
+            ~MappedFile()
+            {
+                close();
+            }
+
+            MappedFile(const MappedFile&) = delete;
+            MappedFile& operator= (const MappedFile&) = delete;
+
+            void open(string fn)
+            {
+                close();
+                int fd = ::open(fn.c_str(), O_RDONLY);
+                if (fd < 0)
+                {
+                    throw runtime_error("Could not open " + fn);
+                }
+                struct stat st;
+                if (fstat(fd, &st) < 0)
+                {
+                    ::close(fd);
+                    throw runtime_error("Could not stat " + fn);
+                }
+                size = st.st_size;
+                if (size > 0)
+                {
+                    void *addr = mmap(nullptr, size, PROT_READ, MAP_SHARED,
+                            fd, 0);
+                    if (addr == MAP_FAILED)
+                    {
+                        ::close(fd);
+                        throw runtime_error("Could not map " + fn);
+                    }
+                    data = static_cast<const char*>(addr);
+                }
+                ::close(fd);
+            }
+
+            void close()
+            {
+                if (data != nullptr)
+                {
+                    munmap(const_cast<char*>(data), size);
+                    data = nullptr;
+                }
+                size = 0;
+            }
+
+            template<class T>
+            const T* at(size_t offset) const
+            {
+                return reinterpret_cast<const T*>(data + offset);
+            }
+
+            const char *data = nullptr;
+            size_t size = 0;
+    };
+
+}
+
+#endif
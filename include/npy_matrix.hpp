@@ -0,0 +1,111 @@
+
+#ifndef NPY_MATRIX_HPP
+#define NPY_MATRIX_HPP
+
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
+#include <string>
+#include <stdexcept>
+#include "mapped_file.hpp"
+
+using namespace std;
+
+namespace mod
+{
+
+    // numpy type string of the values of a matrix
+    template<class T> const char* npy_descr();
+    template<> inline const char* npy_descr<float>() { return "<f4"; }
+    template<> inline const char* npy_descr<double>() { return "<f8"; }
+    template<> inline const char* npy_descr<int32_t>() { return "<i4"; }
+    template<> inline const char* npy_descr<int64_t>() { return "<i8"; }
+
+    // Memory mapped two dimensional C order .npy matrix, like the ones
+    // written by np.lib.format.open_memmap in scripts/graph_engine.py
+    template<class T>
+    class NpyMatrix
+    {
+        public:
+            long n_rows = 0, n_cols = 0;
+
+            NpyMatrix() {}
+
+            NpyMatrix(string fn)
+            {
+                load(fn);
+            }
+
+            void load(string fn)
+            {
+                file.open(fn);
+                if (file.size < 10 or memcmp(file.data, "\x93NUMPY", 6) != 0)
+                {
+                    throw runtime_error(fn + " is not a .npy file");
+                }
+                int major = file.data[6];
+                size_t header_len, offset;
+                const unsigned char *len_bytes =
+                    file.at<unsigned char>(8);
+                if (major == 1)
+                {
+                    header_len = len_bytes[0] | (len_bytes[1] << 8);
+                    offset = 10;
+                }
+                else
+                {
+                    header_len = len_bytes[0] | (len_bytes[1] << 8)
+                        | (len_bytes[2] << 16)
+                        | ((size_t) len_bytes[3] << 24);
+                    offset = 12;
+                }
+                string header(file.data + offset, header_len);
+                if (header.find(string("'descr': '") + npy_descr<T>())
+                        == string::npos)
+                {
+                    throw runtime_error(fn + " does not hold "
+                            + npy_descr<T>() + " values");
+                }
+                if (header.find("'fortran_order': False") == string::npos)
+                {
+                    throw runtime_error(fn + " is not in C order");
+                }
+                size_t shape = header.find("'shape': (");
+                if (shape == string::npos or sscanf(header.c_str() + shape,
+                            "'shape': (%ld, %ld)", &n_rows, &n_cols) != 2)
+                {
+                    throw runtime_error(fn + " is not a matrix");
+                }
+                offset += header_len;
+                if (file.size < offset + n_rows * n_cols * sizeof(T))
+                {
+                    throw runtime_error(fn + " is too short");
+                }
+                data = file.at<T>(offset);
+            }
+
+            void close()
+            {
+                file.close();
+                data = nullptr;
+                n_rows = n_cols = 0;
+            }
+
+            const T* row(long i) const
+            {
+                return data + i * n_cols;
+            }
+
+            T get(long i, long j) const
+            {
+                return data[i * n_cols + j];
+            }
+
+        private:
+            MappedFile file;
+            const T *data = nullptr;
+    };
+
+}
+
+#endif
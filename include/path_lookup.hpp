@@ -0,0 +1,115 @@
+
+#ifndef PATH_LOOKUP_HPP
+#define PATH_LOOKUP_HPP
+
+#include <cstdint>
+#include <list>
+#include <string>
+#include <utility>
+#include <vector>
+#include <algorithm>
+#include <unordered_map>
+#include "npy_matrix.hpp"
+
+using namespace std;
+
+namespace mod
+{
+
+    // Rebuilds shortest paths on demand from the predecessor matrix written
+    // by scripts/graph_engine.py. If cache_size is positive, the most
+    // recently used paths are kept, up to cache_size of them
+    class PathLookup
+    {
+        public:
+            PathLookup() {}
+
+            PathLookup(string fn_preds, size_t cache_size = 0)
+            {
+                load(fn_preds, cache_size);
+            }
+
+            void load(string fn_preds, size_t cache_size = 0)
+            {
+                preds.load(fn_preds);
+                this->cache_size = cache_size;
+                lru.clear();
+                cache.clear();
+            }
+
+            long size() const
+            {
+                return preds.n_rows;
+            }
+
+            // Returns true and fills in the nodes of the path, both ends
+            // included, if the target can be reached from the source
+            bool get_path(int start, int end, vector<int>& path)
+            {
+                long key = (long) start * preds.n_cols + end;
+                auto it = cache.find(key);
+                if (it != cache.end())
+                {
+                    lru.splice(lru.begin(), lru, it->second);
+                    path = it->second->second;
+                    return not path.empty();
+                }
+                path.clear();
+                rebuild_path(start, end, path);
+                if (cache_size > 0)
+                {
+                    lru.emplace_front(key, path);
+                    cache[key] = lru.begin();
+                    if (lru.size() > cache_size)
+                    {
+                        cache.erase(lru.back().first);
+                        lru.pop_back();
+                    }
+                }
+                return not path.empty();
+            }
+
+        private:
+            typedef pair<long, vector<int>> Entry;
+
+            NpyMatrix<int32_t> preds;
+            size_t cache_size = 0;
+            list<Entry> lru;
+            unordered_map<long, list<Entry>::iterator> cache;
+
+            void rebuild_path(int start, int end, vector<int>& path) const
+            {
+                if (start < 0 or end < 0 or start >= preds.n_rows
+                        or end >= preds.n_cols)
+                {
+                    return;
+                }
+                path.push_back(end);
+                if (start == end)
+                {
+                    return;
+                }
+                const int32_t *row = preds.row(start);
+                int node = end;
+                for (long i = 0; i < preds.n_cols; i++)
+                {
+                    node = row[node];
+                    if (node < 0)
+                    {
+                        path.clear();
+                        return;
+                    }
+                    path.push_back(node);
+                    if (node == start)
+                    {
+                        reverse(path.begin(), path.end());
+                        return;
+                    }
+                }
+                path.clear();
+            }
+    };
+
+}
+
+#endif
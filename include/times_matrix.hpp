@@ -0,0 +1,59 @@
+
+#ifndef TIMES_MATRIX_HPP
+#define TIMES_MATRIX_HPP
+
+#include <string>
+#include <stdexcept>
+#include "npy_matrix.hpp"
+
+using namespace std;
+
+namespace mod
+{
+
+    // Memory mapped travel times matrix written by
+    // scripts/create_nyc_graph.py, holding either float32 or float64 values
+    class TimesMatrix
+    {
+        public:
+            TimesMatrix() {}
+
+            TimesMatrix(string fn_times)
+            {
+                load(fn_times);
+            }
+
+            void load(string fn_times)
+            {
+                try
+                {
+                    f8.load(fn_times);
+                    single = false;
+                }
+                catch (const runtime_error&)
+                {
+                    f8.close();
+                    f4.load(fn_times);
+                    single = true;
+                }
+            }
+
+            long size() const
+            {
+                return single ? f4.n_rows : f8.n_rows;
+            }
+
+            double get(int i, int j) const
+            {
+                return single ? f4.get(i, j) : f8.get(i, j);
+            }
+
+        private:
+            NpyMatrix<double> f8;
+            NpyMatrix<float> f4;
+            bool single = false;
+    };
+
+}
+
+#endif
@@ -1,5 +1,9 @@
 
+import io
+import os
 import re
+import datetime
+import numpy as np
 import pandas as pd
 import time
 import shapely.geometry as geom
@@ -131,6 +135,7 @@ date_format = "%Y-%m-%d %H:%M:%S"
 
 nyc_poly = load_kml_poly()
 geom_nyc_poly = None
+arr_nyc_poly = None
 
 fl_huge = 15285050
 
@@ -145,10 +150,49 @@ fn_stations_fields = ["id", "latitude", "longitude"]
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 
-def convert_date_to_interval(str_time, interval):
-    t = time.strptime(str_time, DATE_FORMAT)
-    secs = t.tm_hour * 60 * 60 + t.tm_min * 60 + t.tm_sec
-    return secs / (interval * 60), t.tm_wday
+def local_offsets(naive_secs):
+    """
+    Given wall clock times as seconds since 1970-01-01 00:00:00, this returns
+    the seconds to add to them to get the epoch seconds time.mktime would
+    give for the same wall clock times
+    """
+    offsets = np.empty(naive_secs.shape[0], dtype=np.int64)
+    for i, secs in enumerate(naive_secs):
+        t = time.gmtime(secs)[:8] + (-1,)
+        offsets[i] = int(time.mktime(t)) - secs
+    return offsets
+
+
+def decode_datetimes(str_times, interval=15):
+    """
+    Batch version of time.strptime for a column of DATE_FORMAT strings.
+    Returns a dict of arrays with the epoch seconds (local time, as
+    time.mktime), the day as days since 1970-01-01, the weekday (Monday is
+    0), the calendar year, the ISO year and week, the seconds of the day and
+    the index of the interval of the day for intervals of the given length
+    in minutes
+    """
+    dts = pd.to_datetime(pd.Series(str_times), format=DATE_FORMAT)
+    naive = dts.values.astype("datetime64[s]").astype(np.int64)
+    secs_per_day = 24 * 60 * 60
+    hours, h_inv = np.unique(naive // (60 * 60), return_inverse=True)
+    days, d_inv = np.unique(naive // secs_per_day, return_inverse=True)
+    epoch = datetime.date(1970, 1, 1).toordinal()
+    dates = [datetime.date.fromordinal(epoch + day) for day in days]
+    years = np.array([date.year for date in dates], dtype=np.int64)
+    isos = np.array([date.isocalendar() for date in dates],
+                    dtype=np.int64).reshape(-1, 3)
+    decoded = dict()
+    decoded["epoch"] = naive + local_offsets(hours * 60 * 60)[h_inv]
+    decoded["day"] = naive // secs_per_day
+    # 1970-01-01 was a Thursday
+    decoded["weekday"] = (decoded["day"] + 3) % 7
+    decoded["year"] = years[d_inv]
+    decoded["iso_year"] = isos[d_inv, 0]
+    decoded["week"] = isos[d_inv, 1]
+    decoded["secs"] = naive % secs_per_day
+    decoded["interval"] = decoded["secs"] // (interval * 60)
+    return decoded
 
 
 def get_nyc_poly():
@@ -167,12 +211,42 @@ def get_nyc_poly():
     return geom_nyc_poly
 
 
-def within_region(lons, lats):
-    nyc = get_nyc_poly()
-    bools = list()
-    for lon, lat in zip(lons, lats):
-        bools.append(nyc.contains(geom.Point(lon, lat)))
-    return bools
+def get_nyc_poly_array():
+    """
+    Returns the vertices of the KML outline as an (n, 2) array of lon/lat
+    pairs, with the first vertex repeated at the end
+    """
+    global arr_nyc_poly
+    if arr_nyc_poly is None:
+        arr_nyc_poly = np.array(get_nyc_poly().exterior.coords)[:, :2]
+    return arr_nyc_poly
+
+
+def within_region_mask(lons, lats):
+    """
+    Returns a boolean array of the points inside the KML outline. Points
+    outside of the bounding box of the outline are rejected straight away
+    and the rest go through an even-odd ray casting test, one polygon edge
+    at a time over all points
+    """
+    poly = get_nyc_poly_array()
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    min_lon, min_lat = poly.min(axis=0)
+    max_lon, max_lat = poly.max(axis=0)
+    mask = (lons >= min_lon) & (lons <= max_lon) \
+        & (lats >= min_lat) & (lats <= max_lat)
+    inds = np.flatnonzero(mask)
+    xs = lons[inds]
+    ys = lats[inds]
+    inside = np.zeros(inds.shape[0], dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for (x1, y1), (x2, y2) in zip(poly[:-1], poly[1:]):
+            crosses = (y1 > ys) != (y2 > ys)
+            x_int = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (xs < x_int)
+    mask[inds] = inside
+    return mask
 
 
 def clean_df(df):
@@ -181,23 +255,60 @@ def clean_df(df):
     p_qstr = "pickup_latitude != 0 and pickup_longitude != 0"
     df.query(d_qstr, inplace=True)
     df.query(p_qstr, inplace=True)
-    df = df[within_region(df["pickup_longitude"], df["pickup_latitude"])]
-    df = df[within_region(df["dropoff_longitude"], df["dropoff_latitude"])]
+    p_in = within_region_mask(df["pickup_longitude"].values,
+                              df["pickup_latitude"].values)
+    d_in = within_region_mask(df["dropoff_longitude"].values,
+                              df["dropoff_latitude"].values)
+    df = df[p_in & d_in]
     return df
 
 
-def clean_dict(val_dict):
-    clean = dict()
-    for key in val_dict.keys():
-        k = key.strip()
-        try:
-            clean[k] = float(val_dict[key])
-        except:
-            clean[k] = val_dict[key]
-    return clean
-
-
-def load_data(fn_raw, chunksize):
-    dfs = pd.read_csv(fn_raw, parse_dates=True, infer_datetime_format=True,
-                      chunksize=chunksize, engine="python")
-    return dfs
+def assign_stations(tree, p_lons, p_lats, d_lons, d_lats, n_jobs=-1):
+    """
+    Finds the closest station to every pickup and dropoff in a single
+    multi-threaded query of the tree. Returns the pickup and dropoff station
+    label arrays
+    """
+    pickups = np.column_stack((p_lons, p_lats))
+    dropoffs = np.column_stack((d_lons, d_lats))
+    _, labels = tree.query(np.vstack((pickups, dropoffs)), n_jobs=n_jobs)
+    n_pickups = pickups.shape[0]
+    return labels[:n_pickups], labels[n_pickups:]
+
+
+def read_csv_block(data, names, usecols=None):
+    """
+    Parses a block of CSV lines without a header into the named columns, or
+    only the usecols ones. pandas takes the number of fields from the first
+    line of the block, so a block starting on a row with extra fields at the
+    end would shift its columns. An empty first line with one field per name
+    pins it instead and rows with extra fields keep their columns
+    """
+    if usecols is None:
+        usecols = names
+    cols = sorted(names.index(name) for name in usecols)
+    pin = "," * (len(names) - 1) + "\n"
+    df = pd.read_csv(io.BytesIO(pin + data), header=None, usecols=cols,
+                     index_col=False, engine="c")
+    df.columns = [names[i] for i in cols]
+    return df.iloc[1:].reset_index(drop=True)
+
+
+def chunk_offsets(fn_raw, chunk_size):
+    """
+    Splits the file after its header into byte ranges of roughly chunk_size
+    bytes that start and end on line boundaries. Returns the header line and
+    the list of (start, end) ranges
+    """
+    size = os.path.getsize(fn_raw)
+    ranges = list()
+    with io.open(fn_raw, "rb") as fin:
+        header = fin.readline()
+        start = fin.tell()
+        while start < size:
+            fin.seek(min(start + chunk_size, size) - 1)
+            fin.readline()
+            end = fin.tell()
+            ranges.append((start, end))
+            start = end
+    return header, ranges
@@ -1,83 +1,242 @@
-
+import io
+import hashlib
+import os
+import os.path
+import threading
 import pandas as pd
 import numpy as np
 import tqdm
 import common
+import trip_store
+import station_grid
+import sparse_freqs
 import argparse
-from scipy.spatial import KDTree
 from multiprocessing import Pool
 
 
-parser = argparse.ArgumentParser(
-    description="Computes a frequency distribution for taxi trips")
-parser.add_argument(
-    "--fn_cleaned", dest="fn_cleaned", type=str,
-    default="data/trip_data_short_cleaned.csv",
-    help="Cleaned data used to calculate frequencies")
-parser.add_argument(
-    "--fn_stations", dest="fn_stations", type=str,
-    default="data/stations-mod.csv",
-    help="Should be the stations found from the points.csv")
-parser.add_argument(
-    "--fn_freqs", dest="fn_freqs", type=str,
-    default="data/freqs.npy",
-    help="Output filename for the frequency table")
-args = parser.parse_args()
-
-stations = pd.read_csv(args.fn_stations)
-stations_kd = KDTree(stations.as_matrix(["lng", "lat"]))
-sts = stations.as_matrix(["lng", "lat"])
-n_stations = stations.shape[0]
 interval_length = 15
 mins_per_day = 24 * 60
 intervals_per_day = mins_per_day / interval_length
 n_lines = 165114362
+chunk_bytes = 16 * 1024 * 1024
+store_chunksize = 1000000
+prefetch = 2
+freq_fields = ["pickup_datetime", "pickup_longitude", "pickup_latitude",
+               "dropoff_longitude", "dropoff_latitude"]
+
+# Per worker state, set up once by init_worker
+stations_kd = None
+freqs_shape = None
+stores = dict()
+
+
+def init_worker(fn_stations, n_stations):
+    global stations_kd, freqs_shape
+    stations_kd = station_grid.StationGrid.load(
+        station_grid.grid_path(fn_stations))
+    freqs_shape = (intervals_per_day, 7, n_stations, n_stations)
+
+
+def get_store(store_dir):
+    if store_dir not in stores:
+        stores[store_dir] = trip_store.load_trip_store(store_dir)
+    return stores[store_dir]
+
+
+def count_freqs(intervals, wdays, p_labels, d_labels):
+    """
+    Returns the (flat index, count) pairs of the frequency tensor cells the
+    trips fall in
+    """
+    index = np.ravel_multi_index((intervals, wdays, p_labels, d_labels),
+                                 freqs_shape)
+    return sparse_freqs.count_indices(index)
 
 
 def calc_freqs(df):
     np.seterr(all='ignore')
-    freqs = np.zeros((intervals_per_day, 7, n_stations, n_stations),
-                     dtype=np.int64)
     df = common.clean_df(df)
-    for i, row in df.iterrows():
-        p_dt = row["pickup_datetime"]
-        interval, wday = common.convert_date_to_interval(
-            p_dt, interval_length)
-        pickup = np.array([row["pickup_longitude"],
-                           row["pickup_latitude"]])
-        dropoff = np.array([row["dropoff_longitude"],
-                            row["dropoff_latitude"]])
-        _, p_label = stations_kd.query(pickup)
-        _, d_label = stations_kd.query(dropoff)
-        freqs[interval][wday][p_label][d_label] += 1
+    dec = common.decode_datetimes(df["pickup_datetime"].values,
+                                  interval_length)
+    p_labels, d_labels = common.assign_stations(
+        stations_kd,
+        df["pickup_longitude"].values, df["pickup_latitude"].values,
+        df["dropoff_longitude"].values, df["dropoff_latitude"].values)
+    freqs = count_freqs(dec["interval"], dec["weekday"], p_labels, d_labels)
     del df
     return freqs
 
 
-if __name__ == "__main__":
-    n_workers = 4
-    chunksize = 10000
-    pool = Pool(n_workers, maxtasksperchild=1)
-    dfs = common.load_data(args.fn_cleaned, chunksize)
-    freqs = np.zeros((intervals_per_day, 7, n_stations, n_stations),
-                     dtype=np.int64)
-    stuff_to_do = True
-    pbar = tqdm.tqdm(desc="Computing probabilities")
-    while stuff_to_do:
-        sub_dfs = list()
-        for i in xrange(n_workers):
-            try:
-                sub_dfs.append(next(dfs))
-            except StopIteration:
-                stuff_to_do = False
-            except ValueError:
-                stuff_to_do = False
-        if len(sub_dfs) > 0:
-            freqs += sum(pool.map(calc_freqs, sub_dfs))
-            updated = sum(df.shape[0] for df in sub_dfs)
-            pbar.update(updated)
-            for df in sub_dfs:
-                del df
+def calc_range_freqs(task):
+    """
+    Parses a byte range of a cleaned CSV with the C parser and returns its
+    (index, count) pairs along with the number of bytes it covered
+    """
+    fn_cleaned, start, end, names = task
+    with io.open(fn_cleaned, "rb") as fin:
+        fin.seek(start)
+        data = fin.read(end - start)
+    df = common.read_csv_block(data, names, freq_fields)
+    index, count = calc_freqs(df)
+    return index, count, end - start
+
+
+def calc_store_freqs(task):
+    store_dir, start, end = task
+    trips = trip_store.store_slice(get_store(store_dir), start, end)
+    p_labels, d_labels = common.assign_stations(
+        stations_kd,
+        trips["pickup_longitude"], trips["pickup_latitude"],
+        trips["dropoff_longitude"], trips["dropoff_latitude"])
+    index, count = count_freqs(trips["interval"], trips["weekday"],
+                               p_labels, d_labels)
+    return index, count, end - start
+
+
+def csv_tasks(fn_cleaned):
+    header, ranges = common.chunk_offsets(fn_cleaned, chunk_bytes)
+    names = [f.strip() for f in header.strip().split(",")]
+    return [(fn_cleaned, start, end, names) for start, end in ranges]
+
+
+def store_tasks(store_dir):
+    n_trips = trip_store.store_length(trip_store.load_trip_store(store_dir))
+    return [(store_dir, start, end)
+            for start, end in trip_store.store_chunks(n_trips,
+                                                      store_chunksize)]
+
+
+def partial_path(partial_dir, fn_input):
+    """
+    Returns the partial tensor of an input, named after its base name and a
+    hash of its absolute path, since stores are usually all named
+    trip_store/
+    """
+    fn_input = os.path.abspath(fn_input)
+    name = os.path.splitext(os.path.basename(os.path.normpath(fn_input)))[0]
+    digest = hashlib.sha1(fn_input).hexdigest()[:12]
+    return os.path.join(partial_dir, "{}-{}.npz".format(name, digest))
+
+
+def bounded(tasks, slots):
+    """
+    Yields the tasks, but only once a slot is free. The pool pulls tasks
+    from this in its own thread, so at most the number of slots the
+    semaphore started with are queued or running at any time
+    """
+    for task in tasks:
+        slots.acquire()
+        yield task
+
+
+def stream_freqs(pool, func, tasks, shape, max_pending):
+    """
+    Hands the tasks to the pool, keeping at most max_pending of them in
+    flight, and folds the (index, count) pairs into a SparseFreqs in
+    whatever order they finish
+    """
+    freqs = sparse_freqs.SparseFreqs(shape)
+    slots = threading.BoundedSemaphore(max_pending)
+    total = sum(task[2] - task[1] for task in tasks)
+    pbar = tqdm.tqdm(total=total, desc="Computing probabilities")
+    for index, count, size in pool.imap_unordered(func,
+                                                  bounded(tasks, slots)):
+        slots.release()
+        freqs.add(index, count)
+        pbar.update(size)
     pbar.close()
+    return freqs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Computes a frequency distribution for taxi trips")
+    parser.add_argument(
+        "--fn_cleaned", dest="fn_cleaned", type=str, nargs="+",
+        default=["data/trip_data_short_cleaned.csv"],
+        help="Cleaned data used to calculate frequencies")
+    parser.add_argument(
+        "--fn_stations", dest="fn_stations", type=str,
+        default="data/stations-mod.csv",
+        help="Should be the stations found from the points.csv")
+    parser.add_argument(
+        "--fn_freqs", dest="fn_freqs", type=str,
+        default="data/freqs.npy",
+        help="Output filename for the frequency table")
+    parser.add_argument(
+        "--store_dir", dest="store_dir", type=str, nargs="+", default=None,
+        help="Columnar trip stores made by trip_store.py. When given they\
+        are used instead of the cleaned CSVs")
+    parser.add_argument(
+        "--sparse", dest="sparse", action="store_true",
+        help="Save the frequencies as (index, count) pairs in an .npz file\
+        instead of a dense tensor")
+    parser.add_argument(
+        "--n_workers", dest="n_workers", type=int, default=4,
+        help="Number of worker processes")
+    parser.add_argument(
+        "--partial_dir", dest="partial_dir", type=str, default=None,
+        help="If given, a partial tensor is computed for every input that\
+        does not have one in this directory yet, and the partials are\
+        merged into the existing frequency table")
+    parser.add_argument(
+        "--fn_manifest", dest="fn_manifest", type=str, default=None,
+        help="Partials already merged into the frequency table, each along\
+        with its input. Defaults to the frequency table filename with\
+        .manifest appended")
+    parser.add_argument(
+        "--fn_cum_freqs", dest="fn_cum_freqs", type=str, default=None,
+        help="If given, the running total of the frequency table is saved\
+        to this .npy file for sampling with DemandLookup")
+    args = parser.parse_args()
+
+    stations = pd.read_csv(args.fn_stations)
+    n_stations = stations.shape[0]
+    # Makes sure the grid index is on disk before the workers load it
+    station_grid.load_station_grid(args.fn_stations,
+                                   stations.as_matrix(["lng", "lat"]))
+    shape = (intervals_per_day, 7, n_stations, n_stations)
+    if args.store_dir is None:
+        inputs = args.fn_cleaned
+        make_tasks = csv_tasks
+        func = calc_range_freqs
+    else:
+        inputs = args.store_dir
+        make_tasks = store_tasks
+        func = calc_store_freqs
+    pool = Pool(args.n_workers, initializer=init_worker,
+                initargs=(args.fn_stations, n_stations))
+    max_pending = prefetch * args.n_workers
+    if args.partial_dir is None:
+        tasks = [task for fn_input in inputs for task in make_tasks(fn_input)]
+        freqs = stream_freqs(pool, func, tasks, shape, max_pending)
+        if args.sparse:
+            freqs.save(args.fn_freqs)
+        else:
+            np.save(args.fn_freqs, freqs.to_dense())
+    else:
+        if not os.path.exists(args.partial_dir):
+            os.makedirs(args.partial_dir)
+        partials = list()
+        for fn_input in inputs:
+            fn_partial = partial_path(args.partial_dir, fn_input)
+            if not os.path.exists(fn_partial):
+                freqs = stream_freqs(pool, func, make_tasks(fn_input), shape,
+                                     max_pending)
+                freqs.save(fn_partial + ".tmp")
+                os.rename(fn_partial + ".tmp", fn_partial)
+            partials.append((fn_partial, os.path.abspath(fn_input)))
+        fn_manifest = args.fn_manifest
+        if fn_manifest is None:
+            fn_manifest = args.fn_freqs + ".manifest"
+        merged = sparse_freqs.merge_partials(
+            args.fn_freqs, shape, partials, fn_manifest, args.sparse)
+        print "Merged", len(merged), "new partials into", args.fn_freqs
     pool.close()
-    np.save(args.fn_freqs, freqs)
+    pool.join()
+    if args.fn_cum_freqs is not None:
+        if args.sparse:
+            dense = sparse_freqs.SparseFreqs.load(args.fn_freqs).to_dense()
+        else:
+            dense = np.load(args.fn_freqs, mmap_mode="r")
+        sparse_freqs.save_cumulative(dense, args.fn_cum_freqs)
@@ -1,127 +1,156 @@
 
 import io
+import os
 import common
-import time
+import trip_store
+import station_grid
+import sparse_freqs
+import probs_store
+import demand_store
+import graph_engine
 import csv
 import numpy as np
+import pandas as pd
 import argparse
-import pickle
-import planar
-import scipy.spatial as spatial
 import datetime
-from collections import OrderedDict, defaultdict
+from multiprocessing import Pool
 from progressbar import ProgressBar, ETA, Percentage, Bar
 
 
-fn_probs_fields = ["tau", "day", "pickup", "dropoff", "probability"]
+probs_dtype = np.dtype([("tau", np.int16), ("day", np.int8),
+                        ("pickup", np.int32), ("dropoff", np.int32),
+                        ("probability", np.float64)])
 
 fn_demands_fields = ["pickup_datetime", "pickup_station", "dropoff_datetime",
                      "dropoff_GPS_lon", "dropoff_GPS_lat", "dropoff_station",
                      "pickup_GPS_lon", "pickup_GPS_lat"]
 
-fn_freqs_fields = ["time_interval", "expected_requests"]
+exp_reqs_dtype = np.dtype([("time_interval", np.int16),
+                           ("expected_requests", np.float64)])
+
+intervals_per_day = 24 * 60 / trip_store.interval_length
 
 day_dem_template = "data/demands_{}_{}_{}.csv"
 
+demands_fmt = ["%d", "%d", "%d", "%.15g", "%.15g", "%d", "%.15g", "%.15g"]
 
-def percent_time(str_time):
-    """
-    Given a string representation of a date, this returns the percent of the
-    day that the time is (i.e. 0.5 would be 12 noon)
-    """
-    t = time.strptime(str_time, common.date_format)
-    secs = t.tm_hour * 60 * 60 + t.tm_min * 60 + t.tm_sec
-    return secs / (24 * 60 * 60.0), t.tm_wday
+chunk_bytes = 64 * 1024 * 1024
 
 
-def epoch_seconds(str_time):
-    return int(time.mktime(time.strptime(str_time, common.date_format)))
+def load_graph(fn_graph, as_networkx=False):
+    """
+    Loads the arrays of a compact graph file written by create_nyc_graph.py,
+    or the NetworkX DiGraph and the stations if as_networkx is set
+    """
+    graph = graph_engine.GraphFile(fn_graph)
+    if as_networkx:
+        return graph.networkx(), graph.stations()
+    return graph
 
 
-def load_graph(fn_graph):
-    with open(fn_graph, "r") as fin:
-        fstr = fin.read()
-        G_tuple = pickle.loads(fstr)
-        return G_tuple
+def parse_raw_row(line):
+    """
+    Returns the medallion and the pickup and dropoff coordinates of a raw
+    line, with nan for the coordinates that are missing or cannot be parsed
+    """
+    row = next(csv.reader([line]))
+    coords = np.empty(4)
+    for i in xrange(4):
+        try:
+            coords[i] = float(row[10 + i])
+        except (ValueError, IndexError):
+            coords[i] = np.nan
+    return row[0], coords
 
 
-def file_length(fn_in):
-    with open(fn_in, "rb") as fin:
-        reader = csv.reader(fin)
-        fl = sum(1 for _ in reader) - 1
-        fin.seek(0)
-        return fl
+def clean_chunk(task):
+    """
+    Cleans the lines of the raw file within a byte range. Returns the kept
+    lines joined into a single string, the medallions seen in them, the
+    number of kept lines and the end of the byte range. Lines with coords
+    that are missing or cannot be parsed are dropped
+    """
+    fn_raw, start, end = task
+    with io.open(fn_raw, "rb") as fin:
+        fin.seek(start)
+        lines = [l for l in fin.read(end - start).splitlines() if l]
+    if len(lines) == 0:
+        return "", set(), 0, end
+    # Every line is prefixed with its number, so the lines pandas skips for
+    # having too many fields can still be told apart. The empty first line
+    # pins the number of fields, which pandas otherwise takes from the first
+    # line of the chunk
+    n_fields = len(common.fn_raw_fields) + 1
+    text = "," * (n_fields - 1) + "\n" + "".join(
+        "{},{}\n".format(i, line) for i, line in enumerate(lines))
+    df = pd.read_csv(io.BytesIO(text), header=None,
+                     names=["line"] + common.fn_raw_fields,
+                     usecols=[0, 1, 11, 12, 13, 14],
+                     dtype={"medallion": str}, error_bad_lines=False,
+                     warn_bad_lines=False).iloc[1:]
+    rows = df["line"].values.astype(np.int64)
+    coords = np.full((len(lines), 4), np.nan)
+    coords[rows] = df[common.fn_raw_fields[10:14]] \
+        .apply(pd.to_numeric, errors="coerce").values
+    medallions = np.empty(len(lines), dtype=object)
+    medallions[rows] = df["medallion"].values
+    for i in np.setdiff1d(np.arange(len(lines)), rows):
+        medallions[i], coords[i] = parse_raw_row(lines[i])
+    c_p = common.within_region_mask(coords[:, 0], coords[:, 1])
+    c_d = common.within_region_mask(coords[:, 2], coords[:, 3])
+    keep = np.flatnonzero(c_p & c_d)
+    data = "".join(lines[i] + "\n" for i in keep)
+    medals = set(medallions[keep])
+    return data, medals, keep.shape[0], end
 
 
-def clean_file(fn_raw, fn_cleaned):
+def clean_file_parallel(fn_raw, fn_cleaned, n_workers, chunk_size=chunk_bytes):
+    """
+    Cleans the raw file in a single pass by handing byte ranges of it to a
+    pool of workers. The cleaned chunks are written in their original order.
+    Returns the number of distinct medallions and the number of cleaned rows
+    """
+    header, ranges = common.chunk_offsets(fn_raw, chunk_size)
+    tasks = [(fn_raw, start, end) for start, end in ranges]
     medals = set()
-    poly = planar.Polygon.from_points(common.nyc_poly)
-    with io.open(fn_raw, "rb") as fin:
-        with io.open(fn_cleaned, "wb") as fout:
-            reader = csv.reader(fin)
-            writer = csv.writer(fout)
-            fl = sum(1 for _ in reader) - 1
-            fin.seek(0)
-            pbar = ProgressBar(
-                widgets=["Cleaning File: ", Bar(), Percentage(), "|", ETA()],
-                maxval=fl + 1).start()
-            for i, row in enumerate(reader):
-                if i == 0:
-                    writer.writerow(row)
-                else:
-                    try:
-                        c_p = poly.contains_point(planar.Vec2(
-                            float(row[10]), float(row[11])))
-                        c_d = poly.contains_point(planar.Vec2(
-                            float(row[12]), float(row[13])))
-                        if c_p and c_d:
-                            writer.writerow(row)
-                            medals.add(row[0])
-                    except ValueError:
-                        pass
-                    pbar.update(i + 1)
-            pbar.finish()
-    return len(medals)
-
-
-def extract_frequencies(fn_raw, stations, kd, fl):
-    num_pd = OrderedDict()
-    num_ti = OrderedDict()
-    num_tau = defaultdict(int)
-    num_tau_occ = defaultdict(set)
-    counter = 0
+    n_rows = 0
+    pool = Pool(n_workers)
     pbar = ProgressBar(
-        widgets=["Extracting Frequencies: ", Bar(), Percentage(), "|", ETA()],
-        maxval=fl + 1).start()
-    with io.open(fn_raw, "rb") as fin:
-        reader = csv.DictReader(fin)
-        for i, row in enumerate(reader):
-            if i == 0:
-                continue
-            try:
-                row = common.clean_dict(row)
-                p_time, p_day = percent_time(row["pickup_datetime"])
-                p_l = [row["pickup_longitude"], row["pickup_latitude"]]
-                d_l = [row["dropoff_longitude"], row["dropoff_latitude"]]
-                _, sts = kd.query(np.array([p_l, d_l]))
-                tau = int(4 * 24 * p_time)
-                ti = (tau, p_day)
-                if not ti in num_pd.keys():
-                    num_pd[ti] = dict()
-                if not ti in num_ti:
-                    num_ti[ti] = 0
-                if not (sts[0], sts[1]) in num_pd[ti]:
-                    num_pd[ti][(sts[0], sts[1])] = 0
-                    counter += 1
-                num_pd[ti][(sts[0], sts[1])] += row["passenger_count"]
-                num_ti[ti] += row["passenger_count"]
-                num_tau[tau] += row["passenger_count"]
-                num_tau_occ[tau].add(p_day)
-            except ValueError:
-                pass
-            pbar.update(i + 1)
-        pbar.finish()
-    return num_pd, num_ti, num_tau, num_tau_occ, counter
+        widgets=["Cleaning File: ", Bar(), Percentage(), "|", ETA()],
+        maxval=os.path.getsize(fn_raw)).start()
+    with io.open(fn_cleaned, "wb") as fout:
+        fout.write(header)
+        for data, c_medals, c_rows, end in pool.imap(clean_chunk, tasks):
+            fout.write(data)
+            medals.update(c_medals)
+            n_rows += c_rows
+            pbar.update(end)
+    pbar.finish()
+    pool.close()
+    pool.join()
+    return len(medals), n_rows
+
+
+def extract_frequencies(trips_iter, kd, n_stations):
+    """
+    Sums the passengers of the trips over (day, tau, pickup, dropoff) cells.
+    Returns a SparseFreqs of shape (7, intervals_per_day, n_stations,
+    n_stations), whose flat indices are therefore sorted by day, tau and
+    pickup
+    """
+    shape = (7, intervals_per_day, n_stations, n_stations)
+    freqs = sparse_freqs.SparseFreqs(shape)
+    for trips in trips_iter:
+        p_sts, d_sts = common.assign_stations(
+            kd, trips["pickup_longitude"], trips["pickup_latitude"],
+            trips["dropoff_longitude"], trips["dropoff_latitude"])
+        index = np.ravel_multi_index(
+            (trips["weekday"], trips["interval"], p_sts, d_sts), shape)
+        uniq, inv = np.unique(index, return_inverse=True)
+        count = np.bincount(inv, weights=trips["passenger_count"],
+                            minlength=uniq.shape[0])
+        freqs.add(uniq, count.astype(np.int64))
+    return freqs
 
 
 def create_stations_file(nodes, fn_javier_stations):
@@ -136,33 +165,35 @@ def create_stations_file(nodes, fn_javier_stations):
             javier_writer.writerow(jrow)
 
 
-def create_probs_file(fn_raw, fn_probs, fn_freqs, stations, kd, fl):
-    num_pd, num_ti, num_tau, num_tau_occ, counter = extract_frequencies(
-        fn_raw, stations, kd, fl)
-    pbar = ProgressBar(
-        widgets=["Creating Probabilities File: ", Bar(), Percentage(), "|",
-                 ETA()],
-        maxval=counter).start()
-    with io.open(fn_probs, "wb") as fout:
-        with io.open(fn_freqs, "wb") as fout_freqs:
-            writer = csv.writer(fout)
-            writer.writerow(fn_probs_fields)
-            freqs_writer = csv.writer(fout_freqs)
-            freqs_writer.writerow(fn_freqs_fields)
-            seen = set()
-            i = 0
-            for (t, day) in num_pd.keys():
-                for (p, d) in num_pd[(t, day)].keys():
-                    ti = (t, day)
-                    prob = num_pd[ti][(p, d)] / num_ti[ti]
-                    writer.writerow([t, day, p, d, prob])
-                    exp_reqs = num_tau[t] / float(len(num_tau_occ[t]))
-                    if not t in seen:
-                        freqs_writer.writerow([t, exp_reqs])
-                        seen.add(t)
-                    pbar.update(i + 1)
-                    i += 1
-            pbar.finish()
+def create_probs_file(trips_iter, fn_probs, fn_freqs, kd, n_stations):
+    """
+    Writes the probability of every (tau, day, pickup, dropoff) given its
+    (tau, day) and the expected requests per tau as .npy tables. The
+    probabilities are sorted by day, tau and pickup and get an index on
+    those for probs_store
+    """
+    freqs = extract_frequencies(trips_iter, kd, n_stations)
+    index, count = freqs.pairs()
+    day, tau, pickup, dropoff = np.unravel_index(index, freqs.shape)
+    ti = day * intervals_per_day + tau
+    num_ti = np.bincount(ti, weights=count, minlength=7 * intervals_per_day)
+    probs = np.empty(index.shape[0], dtype=probs_dtype)
+    probs["tau"] = tau
+    probs["day"] = day
+    probs["pickup"] = pickup
+    probs["dropoff"] = dropoff
+    with np.errstate(divide="ignore", invalid="ignore"):
+        probs["probability"] = count / num_ti[ti]
+    np.save(fn_probs, probs)
+    probs_store.save_index(fn_probs, probs, intervals_per_day, n_stations)
+    num_tau = np.bincount(tau, weights=count, minlength=intervals_per_day)
+    num_tau_occ = np.bincount(np.unique(ti) % intervals_per_day,
+                              minlength=intervals_per_day)
+    taus = np.flatnonzero(num_tau_occ)
+    exp_reqs = np.empty(taus.shape[0], dtype=exp_reqs_dtype)
+    exp_reqs["time_interval"] = taus
+    exp_reqs["expected_requests"] = num_tau[taus] / num_tau_occ[taus]
+    np.save(fn_freqs, exp_reqs)
 
 
 def create_times_file(stations, times, fn_times):
@@ -178,65 +209,133 @@ def create_times_file(stations, times, fn_times):
         pbar.finish()
 
 
-def create_demands_file(fn_raw, kd, fl):
+def write_day_demands(trips, kd):
+    """
+    Writes the demands file for a dict of trip columns that all start on
+    the same day
+    """
+    p_l = np.column_stack((trips["pickup_longitude"],
+                           trips["pickup_latitude"]))
+    d_l = np.column_stack((trips["dropoff_longitude"],
+                           trips["dropoff_latitude"]))
+    p_sts, d_sts = common.assign_stations(kd, p_l[:, 0], p_l[:, 1],
+                                          d_l[:, 0], d_l[:, 1])
+    date = datetime.date(1970, 1, 1) \
+        + datetime.timedelta(days=int(trips["pickup_day"][0]))
+    _, week, _ = date.isocalendar()
+    fname = day_dem_template.format(date.weekday() + 1, week, date.year)
+    rows = np.column_stack((trips["pickup_epoch"], p_sts,
+                            trips["dropoff_epoch"], d_l, d_sts, p_l))
+    with io.open(fname, "wb") as fout:
+        fout.write(" ".join(fn_demands_fields) + "\n")
+        fout.write("{}\n".format(rows.shape[0]))
+        np.savetxt(fout, rows, fmt=demands_fmt, delimiter=" ")
+
+
+def create_demands_file(fn_raw, kd, fl, chunksize=100000):
+    """
+    Creates a demands file for every day in the cleaned data. The data is
+    read in chunks and the trips of a day are expected to be contiguous, so
+    the last day of a chunk is carried over to the next one
+    """
     pbar = ProgressBar(
         widgets=["Creating Demands File: ", Bar(),
                  Percentage(), "|", ETA()],
         maxval=fl + 1).start()
-    cur_date = (0, 0, 0)
-    fout = None
-    writer = None
+    carry = None
     counter = 0
-    rows = list()
-    with io.open(fn_raw, "rb") as fin:
-        reader = csv.DictReader(fin)
-        for i, row in enumerate(reader):
-            if i == 0:
-                continue
-            nrow = [None] * len(fn_demands_fields)
-            row = common.clean_dict(row)
-            str_time = row["pickup_datetime"]
-            t = time.strptime(str_time, common.date_format)
-            week = datetime.date(t.tm_year, t.tm_mon, t.tm_mday)\
-                .isocalendar()[1]
-            cdate = (t.tm_wday + 1, week, t.tm_year)
-            if (cdate != cur_date and counter > 0) or i + 1 == fl:
-                cur_date = cdate
-                fname = day_dem_template.format(*cur_date)
-                fout = io.open(fname, "wb")
-                writer = csv.writer(fout, delimiter=" ")
-                writer.writerow(fn_demands_fields)
-                writer.writerow([counter])
-                writer.writerows(rows)
-                rows = list()
-                fout.close()
-                counter = 0
-            p_l = [row["pickup_longitude"], row["pickup_latitude"]]
-            d_l = [row["dropoff_longitude"], row["dropoff_latitude"]]
-            _, sts = kd.query(np.array([p_l, d_l]))
-            nrow[0] = epoch_seconds(row["pickup_datetime"])
-            nrow[1] = sts[0]
-            nrow[2] = epoch_seconds(row["dropoff_datetime"])
-            nrow[3] = row["dropoff_longitude"]
-            nrow[4] = row["dropoff_latitude"]
-            nrow[5] = sts[1]
-            nrow[6] = row["pickup_longitude"]
-            nrow[7] = row["pickup_latitude"]
-            rows.append(nrow)
-            counter += 1
-            pbar.update(i)
-        pbar.finish()
+    for trips in trip_store.iter_csv_trips(fn_raw, chunksize):
+        n_trips = trips["pickup_day"].shape[0]
+        if carry is not None:
+            trips = dict((k, np.concatenate((carry[k], trips[k])))
+                         for k in trips.keys())
+        bounds = np.flatnonzero(np.diff(trips["pickup_day"])) + 1
+        starts = np.append(0, bounds)
+        ends = np.append(bounds, trips["pickup_day"].shape[0])
+        for start, end in zip(starts[:-1], ends[:-1]):
+            write_day_demands(trip_store.store_slice(trips, start, end), kd)
+        carry = trip_store.store_slice(trips, starts[-1], ends[-1])
+        counter += n_trips
+        pbar.update(counter)
+    if carry is not None and carry["pickup_day"].shape[0] > 0:
+        write_day_demands(carry, kd)
+    pbar.finish()
+
+
+# Per worker state, set up once by init_demands_worker
+demands_kd = None
+demands_store = None
+demands_order = None
+
+
+def init_demands_worker(fn_grid, store_dir):
+    global demands_kd, demands_store, demands_order
+    demands_kd = station_grid.StationGrid.load(fn_grid)
+    demands_store = trip_store.load_trip_store(store_dir)
+    demands_order = trip_store.load_day_order(store_dir)
+
+
+def write_store_day(task):
+    """
+    Writes the demands file of the day whose trips are at the given range of
+    the day ordered rows of the store. Returns the number of trips
+    """
+    start, end = task
+    inds = demands_order[start:end]
+    write_day_demands(
+        dict((name, col[inds]) for name, col in demands_store.items()),
+        demands_kd)
+    return end - start
+
 
+def create_demands_file_from_store(store_dir, fn_grid, n_workers):
+    """
+    Same as create_demands_file, but reads the trips from a columnar store.
+    The days are partitioned up front and every day is written by one of a
+    pool of workers
+    """
+    days, ranges = trip_store.write_day_order(store_dir)
+    pbar = ProgressBar(
+        widgets=["Creating Demands Files: ", Bar(),
+                 Percentage(), "|", ETA()],
+        maxval=sum(end - start for start, end in ranges) + 1).start()
+    pool = Pool(n_workers, initializer=init_demands_worker,
+                initargs=(fn_grid, store_dir))
+    counter = 0
+    for n_trips in pool.imap_unordered(write_store_day, ranges):
+        counter += n_trips
+        pbar.update(counter)
+    pool.close()
+    pool.join()
+    pbar.finish()
+    return days.shape[0]
 
-def create_data_files(fn_raw, fn_nodes, fn_cleaned, fn_javier_stations):
-    taxi_count = clean_file(fn_raw, fn_cleaned)
+
+def create_data_files(fn_raw, fn_nodes, fn_cleaned, fn_javier_stations,
+                      n_workers, store_dir=None, fn_probs=None,
+                      fn_exp_reqs=None, fn_demand_store=None):
+    taxi_count, fl = clean_file_parallel(fn_raw, fn_cleaned, n_workers)
     # G, stations = load_graph(fn_graph)
     nodes = np.loadtxt(fn_nodes, delimiter=",")[:, 1:]
-    kd = spatial.KDTree(nodes)
-    print "Determining file length..."
-    fl = file_length(fn_cleaned)
+    kd = station_grid.load_station_grid(fn_nodes, np.fliplr(nodes))
     create_stations_file(nodes, fn_javier_stations)
-    create_demands_file(fn_cleaned, kd, fl)
+    if store_dir is None:
+        create_demands_file(fn_cleaned, kd, fl)
+    else:
+        trip_store.write_trip_store(fn_cleaned, store_dir)
+        create_demands_file_from_store(
+            store_dir, station_grid.grid_path(fn_nodes), n_workers)
+        if fn_demand_store is not None:
+            demand_store.write_demand_store(store_dir, kd, fn_demand_store)
+    if fn_probs is not None:
+        print "Creating probabilities file..."
+        if store_dir is None:
+            trips_iter = trip_store.iter_csv_trips(fn_cleaned)
+        else:
+            trips_iter = trip_store.iter_store_trips(
+                trip_store.load_trip_store(store_dir))
+        create_probs_file(trips_iter, fn_probs, fn_exp_reqs, kd,
+                          nodes.shape[0])
     print "Taxi Count:", taxi_count
     print "Done :D"
 
@@ -263,6 +362,30 @@ if __name__ == "__main__":
         "--fn_javier_stations", dest="fn_javier_stations", type=str,
         default="data/stations_LUT.csv",
         help="Output CSV file for listing the stations. This is for Javier")
+    parser.add_argument(
+        "--n_workers", dest="n_workers", type=int, default=4,
+        help="Number of processes used to clean the raw data and, with\
+        --store_dir, to write the demands files")
+    parser.add_argument(
+        "--store_dir", dest="store_dir", type=str, default=None,
+        help="If given, the cleaned data is also converted into a columnar\
+        trip store in this directory and the demands files of the days are\
+        written from it in parallel")
+    parser.add_argument(
+        "--fn_probs", dest="fn_probs", type=str, default=None,
+        help="If given, the probability of every origin and destination for\
+        a time interval and day is written to this .npy table")
+    parser.add_argument(
+        "--fn_exp_reqs", dest="fn_exp_reqs", type=str,
+        default="data/exp_reqs.npy",
+        help="Output .npy table of expected requests per time interval,\
+        written along with --fn_probs")
+    parser.add_argument(
+        "--fn_demand_store", dest="fn_demand_store", type=str, default=None,
+        help="If given along with --store_dir, the demands are also written\
+        to this binary demand store, see demand_store.py")
     args = parser.parse_args()
     create_data_files(args.fn_raw, args.fn_nodes, args.fn_cleaned,
-                      args.fn_javier_stations)
+                      args.fn_javier_stations, args.n_workers,
+                      args.store_dir, args.fn_probs, args.fn_exp_reqs,
+                      args.fn_demand_store)
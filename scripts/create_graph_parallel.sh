@@ -1,3 +1,10 @@
 #! /bin/bash
 
-parallel --max-procs=7 --joblog sandbox/log scripts/create_graph_worker.sh ::: sat sun ::: $(seq 0 23)
+ROOTDIR="/media/wallarelvo/JAM-DRL/data-network/manhattan"
+
+python scripts/create_nyc_graph.py \
+    --fn_edge_times sat.csv sun.csv \
+    --hour $(seq 0 23) \
+    --out_dir $ROOTDIR \
+    --n_workers 7 \
+    --incremental
@@ -7,7 +7,7 @@ mkdir -p $OUT_DIR
 NYC_DIR=data/nyc-graph/
 EDGE_TIMES_FILE=data/nyc-graph/week.csv
 HOUR=avg
-GRAPH_FILE=$OUT_DIR/manhattan_graph.pickle
+GRAPH_FILE=$OUT_DIR/manhattan_graph.npz
 PATHS_FILE=$OUT_DIR/paths.csv
 TIMES_FILE=$OUT_DIR/times.csv
 RAW_DATA_FILE=data/trip_data_short.csv
@@ -15,6 +15,9 @@ CLEANED_DATA_FILE=$OUT_DIR/trip_data_short_cleaned.csv
 STATIONS_FILE=$OUT_DIR/stations-mod.csv
 JAVIER_STATIONS_FILE=$OUT_DIR/stations_LUT.csv
 FREQS_FILE=$OUT_DIR/freqs.npy
+CUM_FREQS_FILE=$OUT_DIR/freqs_cumsum.npy
+STORE_DIR=$OUT_DIR/trip_store/
+DEMAND_STORE_FILE=$OUT_DIR/demands.bin
 
 echo Running create_nyc_graph.py
 python scripts/create_nyc_graph.py \
@@ -30,7 +33,9 @@ python scripts/create_data_files.py \
     --fn_raw=$RAW_DATA_FILE \
     --fn_nodes=$NYC_DIR/points.csv \
     --fn_cleaned=$CLEANED_DATA_FILE \
-    --fn_javier_stations=$JAVIER_STATIONS_FILE
+    --fn_javier_stations=$JAVIER_STATIONS_FILE \
+    --store_dir=$STORE_DIR \
+    --fn_demand_store=$DEMAND_STORE_FILE
 
 echo Running find_stations.py
 python scripts/find_stations.py \
@@ -40,9 +45,10 @@ python scripts/find_stations.py \
 
 echo Running compute_probs.py
 python scripts/compute_probs.py \
-    --fn_cleaned=$CLEANED_DATA_FILE \
+    --store_dir=$STORE_DIR \
     --fn_stations=$STATIONS_FILE \
-    --fn_freqs=$FREQS_FILE
+    --fn_freqs=$FREQS_FILE \
+    --fn_cum_freqs=$CUM_FREQS_FILE
 
 echo id,lat,lng > $OUT_DIR/stations.csv
 cat $NYC_DIR/points.csv >> $OUT_DIR/stations.csv
@@ -2,13 +2,11 @@
 import argparse
 import networkx as nx
 import numpy as np
-import pickle
 import io
 import csv
 import os
 import os.path
-import geopy as geo
-from geopy.distance import distance
+import graph_engine
 from progressbar import ProgressBar, ETA, Percentage, Bar
 
 
@@ -31,17 +29,19 @@ def load_graph(nyc_dir, fn_edge_times, hour):
 
 
 def path_length(G, path):
-    length = 0.0
-    for i in xrange(len(path) - 1):
-        sdata = G.node[path[i]]
-        edata = G.node[path[i + 1]]
-        src = geo.Point(sdata["lat"], sdata["lon"])
-        end = geo.Point(edata["lat"], edata["lon"])
-        length += distance(src, end).kilometers
-    return length
+    lats = np.array([G.node[i]["lat"] for i in path])
+    lons = np.array([G.node[i]["lon"] for i in path])
+    return graph_engine.haversine(lats[:-1], lons[:-1], lats[1:],
+                                  lons[1:]).sum()
 
 
-def create_paths_file(G, fn_paths, fn_times):
+def create_paths_file(G, fn_paths, fn_times, n_points):
+    """
+    Writes the shortest paths and travel times of the DiGraph from
+    load_graph. The times file has a row for each of the n_points nodes of
+    points.csv, with -1 for the pairs that are not connected, like
+    create_paths_file_csr
+    """
     counter = 0
     pbar = ProgressBar(
         widgets=["Creating Paths File: ", Bar(), Percentage(), "|", ETA()],
@@ -50,15 +50,15 @@ def create_paths_file(G, fn_paths, fn_times):
         with io.open(fn_times, "wb") as ftimes:
             writer = csv.writer(fout, delimiter=" ")
             times_writer = csv.writer(ftimes, delimiter=" ")
-            times_writer.writerow([len(G.nodes())])
-            for i in G.nodes():
+            times_writer.writerow([n_points])
+            for i in xrange(n_points):
+                time_row = [-1] * n_points
+                if i not in G:
+                    times_writer.writerow(time_row)
+                    continue
                 tts, paths = nx.single_source_dijkstra(G, i)
                 rows = list()
-                time_row = [-1] * len(G.nodes())
-                # print sorted(G.nodes())
                 for j in paths.keys():
-                    # print j
-                    # print len(G.nodes())
                     time_row[int(j)] = tts[int(j)]
                     rows.append([int(i), int(j)] + map(int, paths[int(j)]))
                     pbar.update(counter + 1)
@@ -68,7 +68,122 @@ def create_paths_file(G, fn_paths, fn_times):
             pbar.finish()
 
 
-def write_graph(fn_graph, fn_paths, fn_times, nyc_dir, fn_edge_times, hour):
+def times_matrix_path(fn_times):
+    """
+    Returns the filename of the .npy travel times matrix kept next to a
+    times file
+    """
+    return os.path.splitext(fn_times)[0] + ".npy"
+
+
+def create_paths_file_csr(graph, weights, fn_paths, fn_times, fn_preds,
+                          n_workers=1, times_dtype=np.float64,
+                          warm_start=None, lengths=None, fn_dists=None):
+    """
+    Same output as create_paths_file, but the shortest paths come from
+    Dijkstra over the CSR matrix of the graph, run by n_workers processes.
+    The travel times and the predecessors are also kept as .npy matrices,
+    and the paths file is only written if fn_paths is given since the paths
+    can be rebuilt from the predecessors. The times file has a row for
+    every node of points.csv, with -1 for the pairs that are not connected.
+    If fn_times is a .npy file, only the times matrix is written. If
+    fn_dists is given, the road distances in km of the shortest paths are
+    saved there as a matrix like the times, from the edge lengths in the
+    CSR order. warm_start can be the weights along with the times,
+    predecessor and distances matrices of an earlier run over the same
+    graph, in which case only the sources whose shortest path trees changed
+    are solved again
+    """
+    fn_matrix = times_matrix_path(fn_times)
+    if warm_start is None:
+        times, preds = graph_engine.all_pairs(
+            graph, weights, fn_matrix, fn_preds, n_workers,
+            times_dtype=times_dtype, lengths=lengths, fn_dists=fn_dists)
+    else:
+        prev_weights, fn_prev_times, fn_prev_preds, fn_prev_dists = \
+            warm_start
+        times, preds, n_touched = graph_engine.update_pairs(
+            graph, prev_weights, weights, fn_prev_times, fn_prev_preds,
+            fn_matrix, fn_preds, n_workers, lengths=lengths,
+            fn_prev_dists=fn_prev_dists, fn_dists=fn_dists)
+        print "Sources touched: {}/{}".format(n_touched, graph.size())
+    if fn_paths is not None:
+        write_paths_file(graph, preds, fn_paths)
+    if fn_times == fn_matrix:
+        return
+    with io.open(fn_times, "wb") as ftimes:
+        times_writer = csv.writer(ftimes, delimiter=" ")
+        times_writer.writerow([graph.n_nodes])
+        for row in times:
+            times_writer.writerow(row.tolist())
+
+
+def write_paths_file(graph, preds, fn_paths):
+    pbar = ProgressBar(
+        widgets=["Creating Paths File: ", Bar(), Percentage(), "|", ETA()],
+        maxval=graph.size()).start()
+    with io.open(fn_paths, "wb") as fout:
+        writer = csv.writer(fout, delimiter=" ")
+        for k, i in enumerate(graph.nodes):
+            paths = graph_engine.source_paths(i, preds[i])
+            rows = list()
+            for j in sorted(paths.keys()):
+                rows.append([i, j] + map(int, paths[j]))
+            writer.writerows(rows)
+            pbar.update(k + 1)
+    pbar.finish()
+
+
+def write_graph_file(fn_graph, graph, weights, points):
+    """
+    Saves the road graph weighted with the given edge weights as a compact
+    graph file, see graph_engine.save_graph_file
+    """
+    graph_engine.save_graph_file(
+        fn_graph, graph.indptr, graph.indices,
+        np.asarray(weights, dtype=np.float64)[graph.edge_rows],
+        points[:, 1:], graph.nodes)
+
+
+def write_networkx_graph_file(fn_graph, G, stations):
+    """
+    Saves a DiGraph from load_graph as a compact graph file, see
+    graph_engine.save_graph_file
+    """
+    nodes = np.array(sorted(int(i) for i in G.nodes()))
+    compact = -np.ones(stations.shape[0], dtype=np.int64)
+    compact[nodes] = np.arange(nodes.shape[0])
+    edges = np.array([(compact[int(u)], compact[int(v)], w)
+                      for u, v, w in G.edges(data="weight")])
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    indptr = np.searchsorted(edges[:, 0], np.arange(nodes.shape[0] + 1))
+    graph_engine.save_graph_file(fn_graph, indptr, edges[:, 1], edges[:, 2],
+                                 np.fliplr(stations), nodes)
+
+
+def write_csr_graph(graph, points, weights, fn_graph, fn_paths, fn_times,
+                    fn_preds, n_workers=1, times_dtype=np.float64,
+                    warm_start=None, fn_dists=None):
+    """
+    Writes the outputs of the road graph weighted with the given edge
+    weights. The paths file is skipped if fn_paths is None and the road
+    distances matrix if fn_dists is None
+    """
+    dirname = os.path.dirname(fn_times)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    lengths = None
+    if fn_dists is not None:
+        lengths = graph.lengths(points)
+    create_paths_file_csr(graph, weights, fn_paths, fn_times, fn_preds,
+                          n_workers, times_dtype, warm_start, lengths,
+                          fn_dists)
+    write_graph_file(fn_graph, graph, weights, points)
+
+
+def write_graph(fn_graph, fn_paths, fn_times, nyc_dir, fn_edge_times, hour,
+                engine="csgraph", fn_preds=None, n_workers=1,
+                skip_paths=False, times_dtype=np.float64, fn_dists=None):
     # poly = planar.Polygon.from_points(common.nyc_poly)
     # r = poly.bounding_box
     # rect = (r.min_point.x, r.min_point.y, r.max_point.x, r.max_point.y)
@@ -76,13 +191,69 @@ def write_graph(fn_graph, fn_paths, fn_times, nyc_dir, fn_edge_times, hour):
     dirname = os.path.dirname(fn_times)
     if not os.path.exists(dirname):
         os.makedirs(dirname)
-    G, stations = load_graph(nyc_dir, fn_edge_times, hour)
-    create_paths_file(G, fn_paths, fn_times)
-    G_tuple = (G, stations)
-    # print "Writing graph data to file..."
-    pstr = pickle.dumps(G_tuple)
-    with open(fn_graph, "wb") as fout:
-        fout.write(pstr)
+    if engine == "networkx":
+        G, stations = load_graph(nyc_dir, fn_edge_times, hour)
+        create_paths_file(G, fn_paths, fn_times, stations.shape[0])
+        write_networkx_graph_file(fn_graph, G, stations)
+    else:
+        graph, points = graph_engine.load_road_graph(nyc_dir)
+        weights = graph_engine.hour_weights(
+            graph_engine.load_edge_times(fn_edge_times), hour)
+        if fn_preds is None:
+            fn_preds = os.path.join(dirname, "preds.npy")
+        if fn_dists is None:
+            fn_dists = os.path.join(dirname, "dists.npy")
+        if skip_paths:
+            fn_paths = None
+        write_csr_graph(graph, points, weights, fn_graph, fn_paths, fn_times,
+                        fn_preds, n_workers, times_dtype,
+                        fn_dists=fn_dists)
+
+
+def variant_dir(out_dir, fn_edge_times, hour):
+    """
+    Returns the directory of the outputs for an edge times file and hour,
+    named like sat-5 for sat.csv at 5am
+    """
+    name = os.path.splitext(os.path.basename(fn_edge_times))[0]
+    return os.path.join(out_dir, "{}-{}".format(name, hour))
+
+
+def write_variants(nyc_dir, fns_edge_times, hours, out_dir, n_workers=1,
+                   skip_paths=False, times_dtype=np.float64,
+                   incremental=False):
+    """
+    Writes the outputs of every edge times file and hour to its own
+    directory in out_dir. The topology and every edge times file are only
+    loaded once, and each variant only swaps the weights of the graph. If
+    incremental is set, every variant after the first starts from the
+    shortest paths of the one before it
+    """
+    graph, points = graph_engine.load_road_graph(nyc_dir)
+    n_variants = len(fns_edge_times) * len(hours)
+    counter = 0
+    warm_start = None
+    for fn_edge_times in fns_edge_times:
+        edge_times = graph_engine.load_edge_times(fn_edge_times)
+        for hour in hours:
+            counter += 1
+            var_dir = variant_dir(out_dir, fn_edge_times, hour)
+            print "Variant {}/{}: {}".format(counter, n_variants, var_dir)
+            fn_paths = None
+            if not skip_paths:
+                fn_paths = os.path.join(var_dir, "paths.csv")
+            fn_times = os.path.join(var_dir, "times.csv")
+            fn_preds = os.path.join(var_dir, "preds.npy")
+            fn_dists = os.path.join(var_dir, "dists.npy")
+            weights = graph_engine.hour_weights(edge_times, hour)
+            write_csr_graph(
+                graph, points, weights,
+                os.path.join(var_dir, "manhattan_graph.npz"), fn_paths,
+                fn_times, fn_preds, n_workers, times_dtype, warm_start,
+                fn_dists)
+            if incremental:
+                warm_start = (weights, times_matrix_path(fn_times), fn_preds,
+                              fn_dists)
 
 
 if __name__ == "__main__":
@@ -93,16 +264,24 @@ if __name__ == "__main__":
         default="data/nyc-graph/",
         help="Directory for the NYC graph data")
     parser.add_argument(
-        "--fn_edge_times", dest="fn_edge_times", type=str,
-        default="week.csv",
-        help="CSV file with the edge times per hour")
+        "--fn_edge_times", dest="fn_edge_times", type=str, nargs="+",
+        default=["week.csv"],
+        help="CSV file with the edge times per hour. Several can be given\
+        along with --out_dir")
+    parser.add_argument(
+        "--hour", dest="hour", nargs="+", default=["avg"],
+        help="Hour of the day being used to generate the graph. Several can\
+        be given along with --out_dir")
     parser.add_argument(
-        "--hour", dest="hour", default="avg",
-        help="Hour of the day being used to generate the graph")
+        "--out_dir", dest="out_dir", type=str, default=None,
+        help="If given, the outputs of every edge times file and hour are\
+        written to their own directory in here, named like sat-5, and the\
+        output filename options are ignored")
     parser.add_argument(
         "--fn_graph", dest="fn_graph", type=str,
-        default="data/manhattan_graph.pickle",
-        help="Output file for the pickled graph data to be written")
+        default="data/manhattan_graph.npz",
+        help="Output .npz file for the compact graph, see\
+        graph_engine.GraphFile")
     parser.add_argument(
         "--fn_paths", dest="fn_paths", type=str,
         default="data/paths.csv",
@@ -110,7 +289,51 @@ if __name__ == "__main__":
     parser.add_argument(
         "--fn_times", dest="fn_times", type=str,
         default="data/times.csv",
-        help="Output CSV file for listing the travel times between stations")
+        help="Output CSV file for listing the travel times between stations.\
+        The csgraph engine also keeps them as a .npy matrix next to it, and\
+        only writes that matrix if this ends in .npy")
+    parser.add_argument(
+        "--engine", dest="engine", type=str, default="csgraph",
+        choices=["csgraph", "networkx"],
+        help="csgraph runs the shortest paths over a sparse matrix of the\
+        graph, networkx runs Dijkstra from every node of a DiGraph")
+    parser.add_argument(
+        "--fn_preds", dest="fn_preds", type=str, default=None,
+        help="Output .npy matrix of the predecessor of every node on the\
+        shortest path to it from every other node. Defaults to preds.npy\
+        next to the times file")
+    parser.add_argument(
+        "--fn_dists", dest="fn_dists", type=str, default=None,
+        help="Output .npy matrix of the road distances in km of the\
+        shortest paths between every pair of nodes, in the same format as\
+        the times matrix. Defaults to dists.npy next to the times file")
+    parser.add_argument(
+        "--n_workers", dest="n_workers", type=int, default=1,
+        help="Number of processes the sources of the shortest paths are\
+        split over")
+    parser.add_argument(
+        "--skip_paths", dest="skip_paths", action="store_true",
+        help="Do not write the paths file, the paths are rebuilt from the\
+        predecessor matrix instead. Only used by the csgraph engine")
+    parser.add_argument(
+        "--times_dtype", dest="times_dtype", type=str, default="float64",
+        choices=["float32", "float64"],
+        help="Type of the values of the .npy travel times matrix")
+    parser.add_argument(
+        "--incremental", dest="incremental", action="store_true",
+        help="Along with --out_dir, start the shortest paths of every\
+        variant from the ones of the variant before it and only solve again\
+        the sources affected by the changed edge times")
     args = parser.parse_args()
-    write_graph(args.fn_graph, args.fn_paths, args.fn_times, args.nyc_dir,
-                args.fn_edge_times, args.hour)
+    if args.out_dir is not None:
+        write_variants(args.nyc_dir, args.fn_edge_times, args.hour,
+                       args.out_dir, args.n_workers, args.skip_paths,
+                       np.dtype(args.times_dtype), args.incremental)
+    else:
+        if len(args.fn_edge_times) > 1 or len(args.hour) > 1:
+            parser.error("Several edge times files or hours need --out_dir")
+        write_graph(args.fn_graph, args.fn_paths, args.fn_times,
+                    args.nyc_dir, args.fn_edge_times[0], args.hour[0],
+                    args.engine, args.fn_preds, args.n_workers,
+                    args.skip_paths, np.dtype(args.times_dtype),
+                    args.fn_dists)
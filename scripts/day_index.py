@@ -0,0 +1,209 @@
+
+import io
+import os
+import os.path
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+import common
+import tqdm
+from multiprocessing import Pool
+
+
+fn_index_template = "{}.days.npy"
+chunk_bytes = 64 * 1024 * 1024
+pickup_column = common.fn_raw_fields.index("pickup_datetime")
+
+# Every run is a maximal range of lines whose pickups fall in the same hour
+# of the same day
+run_dtype = np.dtype([("day", np.int32), ("weekday", np.int8),
+                      ("hour", np.int8), ("start", np.int64),
+                      ("end", np.int64)])
+
+
+def index_path(fn_raw):
+    return fn_index_template.format(os.path.splitext(fn_raw)[0])
+
+
+def date_day(date):
+    """
+    Returns a datetime.date as days since 1970-01-01
+    """
+    return (date - datetime.date(1970, 1, 1)).days
+
+
+def line_bounds(data):
+    """
+    Returns the start and end byte of every line of a block of lines, with
+    the end past the line break. Blank lines are left out
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord("\n")) + 1
+    if ends.shape[0] == 0 or ends[-1] != buf.shape[0]:
+        ends = np.append(ends, buf.shape[0])
+    starts = np.append(0, ends[:-1])
+    length = ends - starts - (buf[ends - 1] == ord("\n"))
+    length -= (length > 0) \
+        & (buf[np.maximum(starts + length - 1, 0)] == ord("\r"))
+    keep = length > 0
+    return starts[keep], ends[keep]
+
+
+def index_range(task):
+    """
+    Returns the runs of a byte range of the raw file along with the number
+    of bytes it covered
+    """
+    fn_raw, start, end = task
+    with io.open(fn_raw, "rb") as fin:
+        fin.seek(start)
+        data = fin.read(end - start)
+    starts, ends = line_bounds(data)
+    runs = np.zeros(0, dtype=run_dtype)
+    if starts.shape[0] > 0:
+        df = pd.read_csv(io.BytesIO(data), header=None, dtype=str,
+                         usecols=[pickup_column], engine="c")
+        if df.shape[0] != starts.shape[0]:
+            raise ValueError("Could not split {} at bytes {} to {} into lines"
+                             .format(fn_raw, start, end))
+        dec = common.decode_datetimes(df[pickup_column].values)
+        keys = dec["day"] * 24 + dec["secs"] // (60 * 60)
+        firsts = np.append(0, np.flatnonzero(np.diff(keys)) + 1)
+        lasts = np.append(firsts[1:], keys.shape[0]) - 1
+        runs = np.empty(firsts.shape[0], dtype=run_dtype)
+        runs["day"] = dec["day"][firsts]
+        runs["weekday"] = dec["weekday"][firsts]
+        runs["hour"] = keys[firsts] % 24
+        runs["start"] = start + starts[firsts]
+        runs["end"] = start + ends[lasts]
+    return runs, end - start
+
+
+def merge_runs(runs):
+    """
+    Joins runs that continue where the run before them ended
+    """
+    if runs.shape[0] == 0:
+        return runs
+    same = (runs["day"][1:] == runs["day"][:-1]) \
+        & (runs["hour"][1:] == runs["hour"][:-1]) \
+        & (runs["start"][1:] == runs["end"][:-1])
+    firsts = np.append(0, np.flatnonzero(~same) + 1)
+    lasts = np.append(firsts[1:], runs.shape[0]) - 1
+    merged = runs[firsts]
+    merged["end"] = runs["end"][lasts]
+    return merged
+
+
+def build_day_index(fn_raw, n_workers=4, chunk_size=chunk_bytes):
+    """
+    Reads the raw file once and saves the byte ranges of its runs of lines
+    with pickups in the same hour of the same day next to it. The files are
+    sorted by pickup time, so there are about 24 runs per day, but the index
+    stays exact for lines that are out of order. Returns the runs
+    """
+    _, ranges = common.chunk_offsets(fn_raw, chunk_size)
+    tasks = [(fn_raw, start, end) for start, end in ranges]
+    pool = Pool(n_workers)
+    pbar = tqdm.tqdm(total=os.path.getsize(fn_raw),
+                     desc="Indexing " + os.path.basename(fn_raw))
+    chunks = list()
+    for runs, size in pool.imap(index_range, tasks):
+        chunks.append(runs)
+        pbar.update(size)
+    pbar.close()
+    pool.close()
+    pool.join()
+    runs = merge_runs(np.concatenate([np.zeros(0, dtype=run_dtype)]
+                                     + chunks))
+    np.save(index_path(fn_raw), runs)
+    return runs
+
+
+def load_day_index(fn_raw, n_workers=4):
+    """
+    Loads the index of the raw file, building it first if it does not exist
+    or is older than the file
+    """
+    fn_index = index_path(fn_raw)
+    if os.path.exists(fn_index) \
+            and os.path.getmtime(fn_index) >= os.path.getmtime(fn_raw):
+        return np.load(fn_index)
+    return build_day_index(fn_raw, n_workers)
+
+
+def select_runs(runs, weekdays=None, days=None, first_day=None,
+                last_day=None, hours=None):
+    """
+    Returns the runs on the given weekdays, on the given days, from
+    first_day up to last_day, both included, and within the given hours of
+    the day. Days are counted since 1970-01-01 and None matches everything
+    """
+    mask = np.ones(runs.shape[0], dtype=bool)
+    if weekdays is not None:
+        mask &= np.in1d(runs["weekday"], weekdays)
+    if days is not None:
+        mask &= np.in1d(runs["day"], days)
+    if first_day is not None:
+        mask &= runs["day"] >= first_day
+    if last_day is not None:
+        mask &= runs["day"] <= last_day
+    if hours is not None:
+        mask &= np.in1d(runs["hour"], hours)
+    return runs[mask]
+
+
+def copy_runs(fn_raw, runs, fout, block_size=chunk_bytes):
+    """
+    Copies the lines of the runs to an open file, joining runs that touch
+    into a single read. Returns the number of bytes copied
+    """
+    if runs.shape[0] == 0:
+        return 0
+    runs = np.sort(runs, order="start")
+    touch = runs["start"][1:] == runs["end"][:-1]
+    firsts = np.append(0, np.flatnonzero(~touch) + 1)
+    lasts = np.append(firsts[1:], runs.shape[0]) - 1
+    n_bytes = 0
+    with io.open(fn_raw, "rb") as fin:
+        for start, end in zip(runs["start"][firsts], runs["end"][lasts]):
+            fin.seek(start)
+            pos = start
+            while pos < end:
+                data = fin.read(min(block_size, end - pos))
+                fout.write(data)
+                pos += len(data)
+            if not data.endswith("\n"):
+                fout.write("\n")
+            n_bytes += end - start
+    return n_bytes
+
+
+def first_days(runs, weekdays, n_days):
+    """
+    Returns the first n_days days of each of the weekdays that the runs
+    cover
+    """
+    days, firsts = np.unique(runs["day"], return_index=True)
+    wdays = runs["weekday"][firsts]
+    return np.concatenate([np.zeros(0, dtype=days.dtype)]
+                          + [days[wdays == wd][:n_days] for wd in weekdays])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Indexes where every hour of every day starts in the raw\
+        taxi data files")
+    parser.add_argument(
+        "--fn_raw", dest="fn_raw", type=str, nargs="+",
+        default=["data/trip_data_5.csv"],
+        help="CSV files containing the raw NY taxi data.")
+    parser.add_argument(
+        "--n_workers", dest="n_workers", type=int, default=4,
+        help="Number of worker processes")
+    args = parser.parse_args()
+    for fn_raw in args.fn_raw:
+        runs = build_day_index(fn_raw, args.n_workers)
+        print fn_raw, "Days:", np.unique(runs["day"]).shape[0], \
+            "Runs:", runs.shape[0]
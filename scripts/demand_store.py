@@ -0,0 +1,225 @@
+
+import argparse
+import numpy as np
+import common
+import trip_store
+import station_grid
+import tqdm
+
+
+step_secs = 30
+steps_per_day = 24 * 60 * 60 / step_secs
+secs_per_day = 24 * 60 * 60
+
+data_magic = "MODDEMND"
+index_magic = "MODDEMIX"
+version = 1
+
+# Fixed width little endian records, laid out like mod::DemandRecord in
+# include/demand_store.hpp
+record_dtype = np.dtype([("pickup_epoch", "<i8"), ("dropoff_epoch", "<i8"),
+                         ("pickup_station", "<i4"), ("dropoff_station", "<i4"),
+                         ("pickup_lon", "<f8"), ("pickup_lat", "<f8"),
+                         ("dropoff_lon", "<f8"), ("dropoff_lat", "<f8")])
+
+data_header_dtype = np.dtype([("magic", "S8"), ("version", "<u4"),
+                              ("record_size", "<u4"), ("n_records", "<i8"),
+                              ("reserved", "<i8")])
+
+index_header_dtype = np.dtype([("magic", "S8"), ("version", "<u4"),
+                               ("step_secs", "<u4"), ("first_day", "<i8"),
+                               ("n_days", "<i8"), ("steps_per_day", "<i8")])
+
+fn_index_template = "{}.idx"
+
+
+def index_path(fn_demands):
+    return fn_index_template.format(fn_demands)
+
+
+def day_starts(days):
+    """
+    Returns the epoch seconds of the local midnight of every day, given as
+    days since 1970-01-01
+    """
+    naive = np.asarray(days, dtype=np.int64) * secs_per_day
+    return naive + common.local_offsets(naive)
+
+
+def step_cells(days, epochs, first_day, starts):
+    """
+    Returns the (day, step) cell of every pickup, counted from the first day.
+    Pickups past the last step of a day, which only happens on the day the
+    clocks go back, fall in the last step
+    """
+    day_inds = days - first_day
+    steps = (epochs - starts[day_inds]) // step_secs
+    return day_inds * steps_per_day + np.clip(steps, 0, steps_per_day - 1)
+
+
+def write_demand_store(store_dir, kd, fn_demands, chunksize=1000000):
+    """
+    Writes the trips of a columnar trip store as one file of fixed width
+    demand records sorted by pickup time, along with an index file holding
+    the first record of every (day, 30 second step). The records of step s
+    of day d are then offsets[d * steps_per_day + s] up to the next offset.
+    Returns the number of records
+    """
+    store = trip_store.load_trip_store(store_dir)
+    days = np.asarray(store["pickup_day"], dtype=np.int64)
+    epochs = np.asarray(store["pickup_epoch"])
+    n_records = days.shape[0]
+    if n_records == 0:
+        first_day, n_days = 0, 0
+    else:
+        first_day = int(days.min())
+        n_days = int(days.max()) - first_day + 1
+    starts = day_starts(np.arange(first_day, first_day + n_days))
+    cells = step_cells(days, epochs, first_day, starts)
+    order = np.lexsort((epochs, cells))
+    cells = cells[order]
+    del days, epochs
+
+    header = np.zeros(1, dtype=data_header_dtype)
+    header["magic"] = data_magic
+    header["version"] = version
+    header["record_size"] = record_dtype.itemsize
+    header["n_records"] = n_records
+    with open(fn_demands, "wb") as fout:
+        header.tofile(fout)
+    if n_records > 0:
+        records = np.memmap(fn_demands, dtype=record_dtype, mode="r+",
+                            offset=data_header_dtype.itemsize,
+                            shape=(n_records,))
+        for start, end in tqdm.tqdm(trip_store.store_chunks(n_records,
+                                                            chunksize),
+                                    desc="Writing demand records"):
+            inds = order[start:end]
+            trips = dict((name, col[inds]) for name, col in store.items())
+            p_sts, d_sts = common.assign_stations(
+                kd, trips["pickup_longitude"], trips["pickup_latitude"],
+                trips["dropoff_longitude"], trips["dropoff_latitude"])
+            chunk = records[start:end]
+            chunk["pickup_epoch"] = trips["pickup_epoch"]
+            chunk["dropoff_epoch"] = trips["dropoff_epoch"]
+            chunk["pickup_station"] = p_sts
+            chunk["dropoff_station"] = d_sts
+            chunk["pickup_lon"] = trips["pickup_longitude"]
+            chunk["pickup_lat"] = trips["pickup_latitude"]
+            chunk["dropoff_lon"] = trips["dropoff_longitude"]
+            chunk["dropoff_lat"] = trips["dropoff_latitude"]
+        records.flush()
+        del records
+
+    i_header = np.zeros(1, dtype=index_header_dtype)
+    i_header["magic"] = index_magic
+    i_header["version"] = version
+    i_header["step_secs"] = step_secs
+    i_header["first_day"] = first_day
+    i_header["n_days"] = n_days
+    i_header["steps_per_day"] = steps_per_day
+    offsets = np.searchsorted(cells, np.arange(n_days * steps_per_day + 1))
+    with open(index_path(fn_demands), "wb") as fout:
+        i_header.tofile(fout)
+        starts.astype("<i8").tofile(fout)
+        offsets.astype("<i8").tofile(fout)
+    return n_records
+
+
+class DemandStore(object):
+    """
+    Reads a demand store written by write_demand_store. The records and the
+    index are memory mapped, so a day or a range of steps is a slice of the
+    records without any parsing
+    """
+
+    def __init__(self, fn_demands):
+        header = np.fromfile(fn_demands, dtype=data_header_dtype, count=1)[0]
+        if header["magic"] != data_magic \
+                or header["record_size"] != record_dtype.itemsize:
+            raise ValueError("{} is not a demand store".format(fn_demands))
+        fn_index = index_path(fn_demands)
+        i_header = np.fromfile(fn_index, dtype=index_header_dtype,
+                               count=1)[0]
+        if i_header["magic"] != index_magic:
+            raise ValueError("{} is not a demand store index"
+                             .format(fn_index))
+        self.n_records = int(header["n_records"])
+        self.first_day = int(i_header["first_day"])
+        self.n_days = int(i_header["n_days"])
+        self.steps_per_day = int(i_header["steps_per_day"])
+        self.step_secs = int(i_header["step_secs"])
+        if self.n_records > 0:
+            self.records = np.memmap(fn_demands, dtype=record_dtype,
+                                     mode="r",
+                                     offset=data_header_dtype.itemsize,
+                                     shape=(self.n_records,))
+        else:
+            self.records = np.zeros(0, dtype=record_dtype)
+        offset = index_header_dtype.itemsize
+        with open(fn_index, "rb") as fin:
+            fin.seek(offset)
+            self.day_starts = np.fromfile(fin, dtype="<i8",
+                                          count=self.n_days)
+        offset += 8 * self.n_days
+        self.offsets = np.memmap(
+            fn_index, dtype="<i8", mode="r", offset=offset,
+            shape=(self.n_days * self.steps_per_day + 1,))
+
+    def days(self):
+        return np.arange(self.first_day, self.first_day + self.n_days)
+
+    def step_range(self, day, first_step, last_step):
+        """
+        Returns the (start, end) records of the steps first_step to
+        last_step, both included, of a day given as days since 1970-01-01
+        """
+        d = day - self.first_day
+        if d < 0 or d >= self.n_days:
+            return 0, 0
+        first_step = max(first_step, 0)
+        last_step = min(last_step, self.steps_per_day - 1)
+        if last_step < first_step:
+            return 0, 0
+        base = d * self.steps_per_day
+        return (int(self.offsets[base + first_step]),
+                int(self.offsets[base + last_step + 1]))
+
+    def steps(self, day, first_step, last_step):
+        start, end = self.step_range(day, first_step, last_step)
+        return self.records[start:end]
+
+    def day(self, day):
+        return self.steps(day, 0, self.steps_per_day - 1)
+
+    def between(self, day, secs_min, secs_max):
+        """
+        Returns the records of the steps covering secs_min up to, but not
+        including, secs_max seconds after the local midnight of the day
+        """
+        return self.steps(day, secs_min // self.step_secs,
+                          (secs_max - 1) // self.step_secs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Writes the trips of a trip store as a binary demand\
+        store indexed by day and 30 second step")
+    parser.add_argument(
+        "--store_dir", dest="store_dir", type=str,
+        default="data/trip_store/",
+        help="Columnar trip store made by trip_store.py")
+    parser.add_argument(
+        "--fn_nodes", dest="fn_nodes", type=str,
+        default="data/nyc-graph/points.csv",
+        help="Should be the points used for the graph")
+    parser.add_argument(
+        "--fn_demands", dest="fn_demands", type=str,
+        default="data/demands.bin",
+        help="Output file for the demand records. The index is written next\
+        to it with .idx appended")
+    args = parser.parse_args()
+    nodes = np.loadtxt(args.fn_nodes, delimiter=",")[:, 1:]
+    kd = station_grid.load_station_grid(args.fn_nodes, np.fliplr(nodes))
+    n_records = write_demand_store(args.store_dir, kd, args.fn_demands)
+    print "Demands:", n_records
@@ -1,36 +1,59 @@
 
 import common
-import time
+import trip_store
+import day_index
 import argparse
-import csv
+import datetime
 import io
-from collections import defaultdict
+import numpy as np
 
 
-def filter_data_for_day(fn_huge, fn_filtered, wds, max_wds):
+def filter_data_for_day(fn_huges, fn_filtered, wds, max_wds, hours=None,
+                        first_date=None, last_date=None, n_workers=4):
+    """
+    Copies the rows of the first max_wds days of each of the weekdays in wds
+    from the raw files to fn_filtered, optionally only within the given
+    hours of the day and dates. The day index of every raw file tells where
+    the rows are, so they are copied in bulk without parsing them
+    """
     print "Filtering file based on weekday..."
-    current_day = None
-    day_count = defaultdict(int)
-    with io.open(fn_huge, "rb") as fin:
-        with io.open(fn_filtered, "wb") as fout:
-            reader = csv.DictReader(fin)
-            writer = csv.DictWriter(fout, fieldnames=common.fn_raw_fields)
-            writer.writeheader()
-            for i, row in enumerate(reader):
-                if i == 0:
-                    continue
-                row = common.clean_dict(row)
-                str_time = row["pickup_datetime"]
-                t = time.strptime(str_time, common.date_format)
-                if t.tm_wday in wds:
-                    if current_day != t.tm_yday:
-                        current_day = t.tm_yday
-                        if day_count[t.tm_wday] <= max_wds:
-                            day_count[t.tm_wday] += 1
-                        if sum(day_count.values()) > len(wds) * max_wds:
-                            return
-                    if day_count[t.tm_yday] <= max_wds:
-                        writer.writerow(row)
+    if isinstance(fn_huges, basestring):
+        fn_huges = [fn_huges]
+    first_day, last_day = None, None
+    if first_date is not None:
+        first_day = day_index.date_day(first_date)
+    if last_date is not None:
+        last_day = day_index.date_day(last_date)
+    all_runs = [day_index.select_runs(
+                    day_index.load_day_index(fn_huge, n_workers),
+                    weekdays=wds, first_day=first_day, last_day=last_day)
+                for fn_huge in fn_huges]
+    kept = day_index.first_days(np.concatenate(all_runs), wds, max_wds)
+    with io.open(fn_filtered, "wb") as fout:
+        fout.write(",".join(common.fn_raw_fields) + "\n")
+        for fn_huge, runs in zip(fn_huges, all_runs):
+            day_index.copy_runs(
+                fn_huge, day_index.select_runs(runs, days=kept, hours=hours),
+                fout)
+
+
+def filter_store_for_day(store_dir, filtered_dir, wds, max_wds):
+    """
+    Writes the trips of the first max_wds days of each of the weekdays in wds
+    from the trip store in store_dir into a new store in filtered_dir
+    """
+    print "Filtering store based on weekday..."
+    store = trip_store.load_trip_store(store_dir)
+    days, firsts = np.unique(store["pickup_day"], return_index=True)
+    wdays = store["weekday"][firsts]
+    kept = [days[wdays == wd][:max_wds] for wd in wds]
+    mask = np.in1d(store["pickup_day"], np.concatenate(kept))
+    trip_store.write_columns(
+        dict((name, col[mask]) for name, col in store.items()), filtered_dir)
+
+
+def parse_date(text):
+    return datetime.datetime.strptime(text, "%Y-%m-%d").date()
 
 
 if __name__ == "__main__":
@@ -38,19 +61,45 @@ if __name__ == "__main__":
         description="Filters the CSV file to accumulate all the data for a\
         given day of the week")
     parser.add_argument(
-        "--fn_raw", dest="fn_raw", type=str,
-        default="data/trip_data_5.csv",
-        help="CSV file containing the raw NY taxi data.")
+        "--fn_raw", dest="fn_raw", type=str, nargs="+",
+        default=["data/trip_data_5.csv"],
+        help="CSV files containing the raw NY taxi data.")
     parser.add_argument(
         "--fn_filtered", dest="fn_filtered", type=str,
         default="data/data_short.csv",
         help="CSV file containing filtered data for a given day.")
     parser.add_argument(
-        "--weekday", dest="weekday", type=list, default=[0, 1, 2, 3, 4, 5, 6],
+        "--weekday", dest="weekday", type=int, nargs="+",
+        default=[0, 1, 2, 3, 4, 5, 6],
         help="Day of the week to gather data.")
     parser.add_argument(
         "--n_days", dest="n_days", type=int, default=3,
         help="Day of the week to gather data.")
+    parser.add_argument(
+        "--hours", dest="hours", type=int, nargs="+", default=None,
+        help="If given, only the pickups within these hours of the day are\
+        kept.")
+    parser.add_argument(
+        "--first_date", dest="first_date", type=parse_date, default=None,
+        help="If given, days before this YYYY-MM-DD date are skipped.")
+    parser.add_argument(
+        "--last_date", dest="last_date", type=parse_date, default=None,
+        help="If given, days after this YYYY-MM-DD date are skipped.")
+    parser.add_argument(
+        "--n_workers", dest="n_workers", type=int, default=4,
+        help="Number of processes used to index the raw files.")
+    parser.add_argument(
+        "--store_dir", dest="store_dir", type=str, default=None,
+        help="If given, this trip store is filtered instead of the CSV file")
+    parser.add_argument(
+        "--filtered_store_dir", dest="filtered_store_dir", type=str,
+        default="data/trip_store_short/",
+        help="Output trip store used when filtering a trip store.")
     args = parser.parse_args()
-    filter_data_for_day(args.fn_raw, args.fn_filtered, args.weekday,
-                        args.n_days)
+    if args.store_dir is None:
+        filter_data_for_day(args.fn_raw, args.fn_filtered, args.weekday,
+                            args.n_days, args.hours, args.first_date,
+                            args.last_date, args.n_workers)
+    else:
+        filter_store_for_day(args.store_dir, args.filtered_store_dir,
+                             args.weekday, args.n_days)
@@ -3,6 +3,7 @@ import sklearn.neighbors as nn
 import numpy as np
 import pandas as pd
 import argparse
+import station_grid
 
 
 def find_clusters(geos, tol):
@@ -36,6 +37,11 @@ if __name__ == "__main__":
         "--fn_stations", dest="fn_stations", type=str,
         default="data/stations-mod.csv",
         help="Output CSV file for listing the stations")
+    parser.add_argument(
+        "--cell_size", dest="cell_size", type=float,
+        default=station_grid.default_cell_size,
+        help="Cell width in degrees of the grid index saved next to the\
+        stations file")
     args = parser.parse_args()
 
     nyc_nodes = pd.read_csv(args.fn_nodes,
@@ -44,4 +50,6 @@ if __name__ == "__main__":
     stations = find_clusters(nyc_mat, args.dist)
     np.savetxt(args.fn_stations, stations, delimiter=",",
                header="id,lng,lat", fmt=["%d", "%.18f", "%.18f"], comments="")
+    grid = station_grid.StationGrid.build(stations[:, 1:], args.cell_size)
+    grid.save(station_grid.grid_path(args.fn_stations))
     print "Stations:", len(stations)
@@ -0,0 +1,500 @@
+
+import os.path
+import shutil
+import numpy as np
+import scipy.sparse as sp
+import tqdm
+from collections import OrderedDict
+from scipy.sparse import csgraph
+from multiprocessing import Pool
+
+
+hours_per_day = 24
+earth_radius_km = 6367
+shard_size = 64
+check_block = 256
+
+# Per worker state, set up once by init_worker
+worker_graph = None
+worker_matrix = None
+worker_times = None
+worker_preds = None
+worker_lengths = None
+worker_dists = None
+
+
+def load_points(nyc_dir):
+    """
+    Returns the id, lat, lon rows of the graph nodes
+    """
+    return np.loadtxt(os.path.join(nyc_dir, "points.csv"), delimiter=",")
+
+
+def load_edges(nyc_dir):
+    """
+    Returns the zero based source and target node of every edge, in the
+    order of the rows of edges.csv and of the edge times files
+    """
+    edges = np.loadtxt(os.path.join(nyc_dir, "edges.csv"), delimiter=",")
+    return edges[:, 1].astype(np.int64) - 1, edges[:, 2].astype(np.int64) - 1
+
+
+def load_edge_times(fn_edge_times):
+    """
+    Returns the (n_edges, 24) travel times of the edges for every hour
+    """
+    return np.loadtxt(fn_edge_times, delimiter=",")[:, 1:]
+
+
+def hour_weights(edge_times, hour):
+    """
+    Returns the weight of every edge for an hour of the day, or the mean
+    over the day if hour is avg
+    """
+    if hour == "avg":
+        return edge_times.mean(axis=1)
+    return edge_times[:, int(hour)]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Returns the great circle distances in km between arrays of points given
+    in degrees, like GeoLocation::distance in include/demand.hpp
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(a))
+
+
+class RoadGraph(object):
+    """
+    Topology of the road network restricted to its largest strongly
+    connected component, as a CSR matrix over compact node ids. The weights
+    are kept apart from the structure, so the same graph can be weighted
+    with the edge times of any hour. nodes maps compact ids to the original
+    ones and compact maps them back, with -1 for nodes left out
+    """
+
+    def __init__(self, n_nodes, src, dst):
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        # Like nx.DiGraph.add_edge, a repeated edge keeps the weight of its
+        # last row
+        keys = src * n_nodes + dst
+        _, rev_firsts = np.unique(keys[::-1], return_index=True)
+        rows = keys.shape[0] - 1 - rev_firsts
+        full = sp.csr_matrix(
+            (np.ones(rows.shape[0]), (src[rows], dst[rows])),
+            shape=(n_nodes, n_nodes))
+        _, labels = csgraph.connected_components(full, directed=True,
+                                                 connection="strong")
+        largest = np.argmax(np.bincount(labels))
+        self.n_nodes = n_nodes
+        self.nodes = np.flatnonzero(labels == largest)
+        self.compact = -np.ones(n_nodes, dtype=np.int64)
+        self.compact[self.nodes] = np.arange(self.nodes.shape[0])
+        keep = (labels[src[rows]] == largest) & (labels[dst[rows]] == largest)
+        # The rows are sorted by source and target, and so are their compact
+        # ids, which makes them the CSR order
+        self.edge_rows = rows[keep]
+        c_src = self.compact[src[self.edge_rows]]
+        self.indices = self.compact[dst[self.edge_rows]]
+        self.indptr = np.searchsorted(c_src, np.arange(self.size() + 1))
+
+    def size(self):
+        return self.nodes.shape[0]
+
+    def matrix(self, weights):
+        """
+        Returns the CSR matrix of the graph weighted with the given weight
+        for every row of edges.csv
+        """
+        data = np.asarray(weights, dtype=np.float64)[self.edge_rows]
+        return sp.csr_matrix((data, self.indices, self.indptr),
+                             shape=(self.size(), self.size()))
+
+    def sources(self):
+        """
+        Returns the compact source of every edge, in the CSR order
+        """
+        return np.repeat(np.arange(self.size()), np.diff(self.indptr))
+
+    def lengths(self, points):
+        """
+        Returns the length in km of every edge in the CSR order, from the
+        id, lat, lon rows of points.csv
+        """
+        src = points[self.nodes[self.sources()]]
+        dst = points[self.nodes[self.indices]]
+        return haversine(src[:, 1], src[:, 2], dst[:, 1], dst[:, 2])
+
+
+def save_graph_file(fn_graph, indptr, indices, weights, coords, nodes):
+    """
+    Saves a weighted graph over compact node ids as .npz arrays: the CSR
+    indptr, indices and weights of its edges, the lat, lon coords of every
+    node of points.csv and the original id of every compact node
+    """
+    with open(fn_graph, "wb") as fout:
+        np.savez(fout, indptr=np.asarray(indptr, dtype=np.int32),
+                 indices=np.asarray(indices, dtype=np.int32),
+                 weights=np.asarray(weights, dtype=np.float64),
+                 coords=np.asarray(coords, dtype=np.float64),
+                 nodes=np.asarray(nodes, dtype=np.int32))
+
+
+class GraphFile(object):
+    """
+    Weighted graph saved by save_graph_file, loaded as plain arrays. compact
+    maps the original node ids to the compact ones, with -1 for nodes left
+    out of the graph
+    """
+
+    def __init__(self, fn_graph):
+        with np.load(fn_graph) as data:
+            self.indptr = data["indptr"]
+            self.indices = data["indices"]
+            self.weights = data["weights"]
+            self.coords = data["coords"]
+            self.nodes = data["nodes"]
+        self.compact = -np.ones(self.coords.shape[0], dtype=np.int32)
+        self.compact[self.nodes] = np.arange(self.nodes.shape[0])
+
+    def size(self):
+        return self.nodes.shape[0]
+
+    def matrix(self):
+        return sp.csr_matrix((self.weights, self.indices, self.indptr),
+                             shape=(self.size(), self.size()))
+
+    def stations(self):
+        """
+        Returns the lon, lat of every node, like the stations of the pickled
+        graph files
+        """
+        return np.fliplr(self.coords)
+
+    def networkx(self):
+        """
+        Returns the graph as a NetworkX DiGraph over the original node ids,
+        with the lat and lon of the nodes and the weight of the edges
+        """
+        import networkx as nx
+        G = nx.DiGraph()
+        for i in self.nodes.tolist():
+            G.add_node(i, lat=self.coords[i][0], lon=self.coords[i][1])
+        src = self.nodes[np.repeat(np.arange(self.size()),
+                                   np.diff(self.indptr))]
+        dst = self.nodes[self.indices]
+        G.add_weighted_edges_from(
+            zip(src.tolist(), dst.tolist(), self.weights.tolist()))
+        return G
+
+
+def load_road_graph(nyc_dir):
+    points = load_points(nyc_dir)
+    src, dst = load_edges(nyc_dir)
+    return RoadGraph(points.shape[0], src, dst), points
+
+
+def shortest_paths(matrix, sources=None):
+    """
+    Runs Dijkstra from the given compact sources, or from every node.
+    Returns the travel times and the predecessor of every node on the
+    shortest path to it, with inf and -1 for nodes that cannot be reached
+    """
+    times, preds = csgraph.dijkstra(matrix, directed=True, indices=sources,
+                                    return_predecessors=True)
+    preds[preds < 0] = -1
+    return times, preds
+
+
+def tree_lengths(graph, lengths, times, preds):
+    """
+    Adds up the edge lengths, in the CSR order, along the shortest paths
+    given by rows of compact times and predecessors. Every node takes the
+    length of its path from the one before it, doubling the jump at each
+    step, so it takes about log2 of the deepest path steps. Unreachable
+    nodes get inf
+    """
+    m = graph.size()
+    keys = graph.sources() * m + graph.indices
+    has_pred = preds >= 0
+    parents = np.where(has_pred, preds, 0)
+    pos = np.searchsorted(keys, parents * m + np.arange(m))
+    dists = np.where(has_pred, lengths[np.minimum(pos, keys.shape[0] - 1)],
+                     0.0)
+    ancestors = np.where(has_pred, preds, -1)
+    jump = has_pred
+    while jump.any():
+        safe = np.where(jump, ancestors, 0)
+        dists = dists + np.where(
+            jump, np.take_along_axis(dists, safe, axis=1), 0.0)
+        ancestors = np.where(
+            jump, np.take_along_axis(ancestors, safe, axis=1), -1)
+        jump = ancestors >= 0
+    dists[~np.isfinite(times)] = np.inf
+    return dists
+
+
+def expand_values(graph, values):
+    """
+    Turns rows of compact values into rows over the original node ids, with
+    -1 for the nodes that are unreachable or left out of the graph
+    """
+    full = -np.ones((values.shape[0], graph.n_nodes))
+    full[:, graph.nodes] = np.where(np.isfinite(values), values, -1)
+    return full
+
+
+def expand_rows(graph, times, preds):
+    """
+    Turns rows of compact times and predecessors into rows over the
+    original node ids, with -1 for the nodes that are unreachable or left
+    out of the graph
+    """
+    full_preds = -np.ones((times.shape[0], graph.n_nodes), dtype=np.int32)
+    full_preds[:, graph.nodes] = np.where(preds >= 0, graph.nodes[preds], -1)
+    return expand_values(graph, times), full_preds
+
+
+def source_paths(source, preds_row):
+    """
+    Rebuilds the shortest paths from the source to every node it reaches,
+    given the row of the source in a predecessor matrix. Returns a dict
+    from target to the list of nodes of its path, both ends included
+    """
+    paths = {source: [source]}
+    for target in np.flatnonzero(preds_row >= 0):
+        chain = list()
+        node = target
+        while node not in paths:
+            chain.append(node)
+            node = preds_row[node]
+        path = paths[node]
+        for node in reversed(chain):
+            path = path + [node]
+            paths[node] = path
+    return paths
+
+
+def rebuild_path(preds, source, target):
+    """
+    Walks the predecessor matrix back from the target. Returns the list of
+    nodes of the shortest path, both ends included, or None if the target
+    cannot be reached from the source
+    """
+    if source == target:
+        return [source]
+    row = preds[source]
+    path = [target]
+    node = target
+    for _ in xrange(row.shape[0]):
+        node = int(row[node])
+        if node < 0:
+            return None
+        path.append(node)
+        if node == source:
+            path.reverse()
+            return path
+    return None
+
+
+class PathLookup(object):
+    """
+    Rebuilds shortest paths on demand from a memory mapped predecessor
+    matrix, as written by all_pairs. If cache_size is positive, the most
+    recently used paths are kept, up to cache_size of them
+    """
+
+    def __init__(self, fn_preds, cache_size=0):
+        self.preds = np.load(fn_preds, mmap_mode="r")
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def path(self, source, target):
+        key = (source, target)
+        if key in self.cache:
+            path = self.cache.pop(key)
+            self.cache[key] = path
+            return path
+        path = rebuild_path(self.preds, source, target)
+        if self.cache_size > 0:
+            self.cache[key] = path
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return path
+
+
+def load_times(fn_times):
+    """
+    Returns the travel times matrix of a .npy file memory mapped, or of a
+    times.csv text file read into memory
+    """
+    if fn_times.endswith(".npy"):
+        return np.load(fn_times, mmap_mode="r")
+    return np.loadtxt(fn_times, skiprows=1, ndmin=2)
+
+
+def convert_times(fn_times, fn_matrix, dtype=np.float64):
+    """
+    Saves the travel times of a times.csv text file as a .npy matrix of the
+    given float type
+    """
+    np.save(fn_matrix, load_times(fn_times).astype(dtype))
+
+
+def init_worker(graph, weights, fn_times, fn_preds, lengths=None,
+                fn_dists=None):
+    global worker_graph, worker_matrix, worker_times, worker_preds
+    global worker_lengths, worker_dists
+    worker_graph = graph
+    worker_matrix = graph.matrix(weights)
+    worker_times = np.load(fn_times, mmap_mode="r+")
+    worker_preds = np.load(fn_preds, mmap_mode="r+")
+    worker_lengths = lengths
+    worker_dists = None
+    if fn_dists is not None:
+        worker_dists = np.load(fn_dists, mmap_mode="r+")
+
+
+def solve_shard(sources):
+    """
+    Runs Dijkstra from the given compact sources and writes their rows
+    straight into the memory mapped matrices, along with the road distances
+    of the paths if there is a distances matrix. Returns the number of
+    sources
+    """
+    times, preds = shortest_paths(worker_matrix, sources)
+    full_times, full_preds = expand_rows(worker_graph, times, preds)
+    rows = worker_graph.nodes[sources]
+    worker_times[rows] = full_times
+    worker_preds[rows] = full_preds
+    if worker_dists is not None:
+        worker_dists[rows] = expand_values(
+            worker_graph, tree_lengths(worker_graph, worker_lengths, times,
+                                       preds))
+    return sources.shape[0]
+
+
+def solve_sources(graph, weights, fn_times, fn_preds, sources, n_workers=1,
+                  shard=shard_size, lengths=None, fn_dists=None):
+    """
+    Splits the compact sources in shards that a pool of workers solves, each
+    worker writing its rows into the matrices itself
+    """
+    tasks = [sources[start:start + shard]
+             for start in xrange(0, sources.shape[0], shard)]
+    pbar = tqdm.tqdm(total=sources.shape[0], desc="Solving shortest paths")
+    if n_workers > 1:
+        pool = Pool(n_workers, initializer=init_worker,
+                    initargs=(graph, weights, fn_times, fn_preds, lengths,
+                              fn_dists))
+        for n_sources in pool.imap_unordered(solve_shard, tasks):
+            pbar.update(n_sources)
+        pool.close()
+        pool.join()
+    else:
+        init_worker(graph, weights, fn_times, fn_preds, lengths, fn_dists)
+        for task in tasks:
+            pbar.update(solve_shard(task))
+        worker_times.flush()
+        worker_preds.flush()
+        if worker_dists is not None:
+            worker_dists.flush()
+    pbar.close()
+
+
+def create_matrix(fn, n, dtype):
+    """
+    Saves an (n, n) .npy matrix of the given type filled with -1
+    """
+    matrix = np.lib.format.open_memmap(fn, mode="w+", dtype=dtype,
+                                       shape=(n, n))
+    matrix[:] = -1
+    matrix.flush()
+
+
+def all_pairs(graph, weights, fn_times, fn_preds, n_workers=1,
+              shard=shard_size, times_dtype=np.float64, lengths=None,
+              fn_dists=None):
+    """
+    Writes the travel times and the predecessors of all pairs of nodes to
+    memory mapped .npy matrices over the original node ids, with -1 for the
+    pairs that are not connected. The sources are split in shards that a
+    pool of workers solves, each worker writing its rows into the matrices
+    itself. If fn_dists is given, the edge lengths in the CSR order are
+    added up along the shortest paths into a road distances matrix of the
+    same type as the times. Returns the times and predecessor matrices,
+    memory mapped read-only
+    """
+    create_matrix(fn_times, graph.n_nodes, times_dtype)
+    create_matrix(fn_preds, graph.n_nodes, np.int32)
+    if fn_dists is not None:
+        create_matrix(fn_dists, graph.n_nodes, times_dtype)
+    solve_sources(graph, weights, fn_times, fn_preds,
+                  np.arange(graph.size()), n_workers, shard, lengths,
+                  fn_dists)
+    return (np.load(fn_times, mmap_mode="r"),
+            np.load(fn_preds, mmap_mode="r"))
+
+
+def affected_sources(graph, old_weights, new_weights, times, preds,
+                     block=check_block):
+    """
+    Returns the compact sources whose shortest path trees can change when
+    the edge weights go from old_weights to new_weights, given the times
+    and predecessors for the old weights. A tree only changes if one of its
+    edges got slower or if an edge that got faster now gives a shorter path
+    to its target. Every other tree is still a shortest path tree
+    """
+    old_data = np.asarray(old_weights, dtype=np.float64)[graph.edge_rows]
+    new_data = np.asarray(new_weights, dtype=np.float64)[graph.edge_rows]
+    changed = np.flatnonzero(old_data != new_data)
+    src = graph.nodes[graph.sources()[changed]]
+    dst = graph.nodes[graph.indices[changed]]
+    slower = new_data[changed] > old_data[changed]
+    faster = ~slower
+    affected = np.zeros(graph.size(), dtype=bool)
+    if changed.shape[0] == 0:
+        return np.flatnonzero(affected)
+    for start in xrange(0, graph.size(), block):
+        rows = graph.nodes[start:start + block]
+        hit = (preds[rows][:, dst[slower]] == src[slower]).any(axis=1)
+        block_times = times[rows]
+        hit |= (block_times[:, src[faster]] + new_data[changed][faster]
+                < block_times[:, dst[faster]]).any(axis=1)
+        affected[start:start + block] = hit
+    return np.flatnonzero(affected)
+
+
+def copy_matrix(fn_prev, fn):
+    if os.path.abspath(fn_prev) != os.path.abspath(fn):
+        shutil.copyfile(fn_prev, fn)
+
+
+def update_pairs(graph, old_weights, new_weights, fn_prev_times,
+                 fn_prev_preds, fn_times, fn_preds, n_workers=1,
+                 shard=shard_size, lengths=None, fn_prev_dists=None,
+                 fn_dists=None):
+    """
+    Same as all_pairs for the new weights, but starts from the matrices
+    all_pairs wrote for the old weights on the same graph and only solves
+    the sources whose shortest path trees are affected by the change. The
+    matrices are updated in place if the filenames are the same, and the
+    road distances need the previous ones. Returns the times and
+    predecessor matrices, memory mapped read-only, and the number of
+    sources that were solved again
+    """
+    copy_matrix(fn_prev_times, fn_times)
+    copy_matrix(fn_prev_preds, fn_preds)
+    if fn_dists is not None:
+        copy_matrix(fn_prev_dists, fn_dists)
+    sources = affected_sources(graph, old_weights, new_weights,
+                               np.load(fn_times, mmap_mode="r"),
+                               np.load(fn_preds, mmap_mode="r"))
+    solve_sources(graph, new_weights, fn_times, fn_preds, sources,
+                  n_workers, shard, lengths, fn_dists)
+    return (np.load(fn_times, mmap_mode="r"),
+            np.load(fn_preds, mmap_mode="r"), sources.shape[0])
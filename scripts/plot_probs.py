@@ -2,14 +2,17 @@
 import argparse
 import csv
 import io
+import os
+import os.path
 import matplotlib.pyplot as plt
-import common
 import seaborn as sns
 import pandas
 import numpy as np
+import probs_store
+import tqdm
 from numpy import median
-from collections import defaultdict
 from string import Template
+from multiprocessing import Pool
 
 
 DS = "Dropoff Station"
@@ -18,6 +21,7 @@ MAP_TEMPLATE = "sandbox/map_template.html"
 MAP_ACTUAL = "sandbox/map.html"
 MAP_PICKUP_CUMULATIVE = "sandbox/map_pickup_cumulative.html"
 MAP_DROPOFF_CUMULATIVE = "sandbox/map_dropoff_cumulative.html"
+MAP_ATLAS = "map_{first}-{last}_{pickup}.html"
 
 
 coord_template = Template(
@@ -44,44 +48,33 @@ def load_stations(fn_stations):
     return np.array(sts)
 
 
+def sum_by(keys, values):
+    uniq, inv = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inv, weights=values, minlength=uniq.shape[0])
+    return uniq, sums
+
+
 def load_probs(fn_probs, interval_min, interval_max, weekdays, pickup,
                n_keep=-1):
     probs = dict()
-    probs[DS] = list()
-    probs[PR] = list()
-    dd = defaultdict(float)
-    with io.open(fn_probs, "rb") as fin:
-        reader = csv.DictReader(fin)
-        for i, row in enumerate(reader):
-            if i == 0:
-                continue
-            row = common.clean_dict(row)
-            int_within = interval_min <= row["tau"] <= interval_max
-            wd_eq = row["day"] == weekdays
-            pickup_eq = row["pickup"] == pickup
-            if int_within and wd_eq and pickup_eq:
-                dd[row["dropoff"]] += row["probability"]
-        if n_keep > len(dd.values()):
-            n_keep = len(dd.values())
-        probs[DS] = map(int, dd.keys())[:n_keep]
-        probs[PR] = dd.values()[:n_keep]
-        return probs
+    rows = probs_store.ProbsStore(fn_probs).rows(
+        interval_min, interval_max, weekdays, pickup)
+    dropoffs, sums = sum_by(rows["dropoff"], rows["probability"])
+    if n_keep > len(dropoffs) or n_keep < 0:
+        n_keep = len(dropoffs)
+    probs[DS] = map(int, dropoffs)[:n_keep]
+    probs[PR] = list(sums)[:n_keep]
+    return probs
 
 
 def load_cumulative_probs(fn_probs, interval_min, interval_max, weekdays):
-    dropoff_probs = defaultdict(float)
-    pickup_probs = defaultdict(float)
-    with io.open(fn_probs, "rb") as fin:
-        reader = csv.DictReader(fin)
-        next(reader)
-        for row in reader:
-            row = common.clean_dict(row)
-            int_within = interval_min <= row["tau"] <= interval_max
-            wd_eq = row["day"] in weekdays
-            if int_within and wd_eq:
-                dropoff_probs[row["dropoff"]] += row["probability"]
-                pickup_probs[row["pickup"]] += row["probability"]
-        return pickup_probs, dropoff_probs
+    rows = probs_store.ProbsStore(fn_probs).rows(
+        interval_min, interval_max, weekdays)
+    pickups, p_sums = sum_by(rows["pickup"], rows["probability"])
+    dropoffs, d_sums = sum_by(rows["dropoff"], rows["probability"])
+    pickup_probs = dict(zip(pickups, p_sums))
+    dropoff_probs = dict(zip(dropoffs, d_sums))
+    return pickup_probs, dropoff_probs
 
 
 def plot_probs_bar_graph(fn_probs, interval_min, interval_max, weekdays,
@@ -98,29 +91,107 @@ def plot_probs_bar_graph(fn_probs, interval_min, interval_max, weekdays,
     plt.xlabel("Likelihood")
 
 
+def heatmap_html(template, sts, dropoffs, probs, pickup):
+    """
+    Fills the map template with the dropoff stations weighted by their
+    normalized probabilities and centered on the pickup station
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    normed = probs / probs.sum()
+    coords = list()
+    for dropoff, prob in zip(dropoffs, normed):
+        coord = coord_template.substitute(
+            lat=sts[dropoff][1], lon=sts[dropoff][0], prob=100 * prob)
+        coords.append(coord)
+    pickup_gmaps = latlon_template.substitute(lat=sts[pickup][1],
+                                              lon=sts[pickup][0])
+    return template.substitute(coords=",".join(c for c in coords),
+                               pickup=pickup_gmaps)
+
+
 def plot_heatmap(fn_probs, fn_stations, interval_min, interval_max,
                  weekdays, pickup):
     with open(MAP_TEMPLATE, "rb") as fin:
         template = Template(fin.read())
-        p_args = [fn_probs, interval_min, interval_max, weekdays, pickup]
-        probs = load_probs(*p_args)
-        sts = load_stations(fn_stations)
-        coords = list()
-        normed = normalize(probs[PR])
-        for i in xrange(len(probs[DS])):
-            lat = sts[probs[DS][i]][1]
-            lon = sts[probs[DS][i]][0]
-            prob = normed[i]
-            coord = coord_template.substitute(
-                lat=lat, lon=lon, prob=100 * prob)
-            coords.append(coord)
-        p_lat = sts[pickup][1]
-        p_lon = sts[pickup][0]
-        pickup_gmaps = latlon_template.substitute(lat=p_lat, lon=p_lon)
-        map_html = template.substitute(coords=",".join(c for c in coords),
-                                       pickup=pickup_gmaps)
-        with open(MAP_ACTUAL, "wb") as fout:
-            fout.write(map_html)
+    p_args = [fn_probs, interval_min, interval_max, weekdays, pickup]
+    probs = load_probs(*p_args)
+    sts = load_stations(fn_stations)
+    map_html = heatmap_html(template, sts, probs[DS], probs[PR], pickup)
+    with open(MAP_ACTUAL, "wb") as fout:
+        fout.write(map_html)
+
+
+def bucket_probs(fn_probs, interval_min, interval_max, weekdays,
+                 bucket_size):
+    """
+    Sums the probabilities of every (interval bucket, pickup, dropoff) over
+    the weekdays and the intervals of the bucket, with the table read once.
+    Yields the (bucket, pickup, dropoffs, probs) of every pickup that has
+    trips in a bucket
+    """
+    store = probs_store.ProbsStore(fn_probs)
+    n = store.n_stations
+    rows = store.rows(interval_min, interval_max, weekdays)
+    buckets = (rows["tau"].astype(np.int64) - interval_min) / bucket_size
+    keys = (buckets * n + rows["pickup"]) * n + rows["dropoff"]
+    keys, sums = sum_by(keys, rows["probability"])
+    groups = keys / n
+    bounds = np.concatenate(
+        ([0], np.flatnonzero(np.diff(groups)) + 1, [groups.shape[0]]))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end > start:
+            bucket, pickup = divmod(int(groups[start]), n)
+            yield bucket, pickup, keys[start:end] % n, sums[start:end]
+
+
+# Per worker state, set up once by init_atlas_worker
+atlas_template = None
+atlas_sts = None
+
+
+def init_atlas_worker(fn_stations):
+    global atlas_template, atlas_sts
+    with open(MAP_TEMPLATE, "rb") as fin:
+        atlas_template = Template(fin.read())
+    atlas_sts = load_stations(fn_stations)
+
+
+def write_atlas_map(task):
+    fn_html, pickup, dropoffs, probs = task
+    with open(fn_html, "wb") as fout:
+        fout.write(heatmap_html(atlas_template, atlas_sts, dropoffs, probs,
+                                pickup))
+    return fn_html
+
+
+def plot_heatmap_atlas(fn_probs, fn_stations, interval_min, interval_max,
+                       weekdays, bucket_size, atlas_dir, n_workers):
+    """
+    Writes the dropoff heatmap of every pickup station and every bucket of
+    bucket_size intervals to atlas_dir, rendering the maps in n_workers
+    processes. Returns the number of maps written
+    """
+    if not os.path.exists(atlas_dir):
+        os.makedirs(atlas_dir)
+
+    def tasks():
+        for bucket, pickup, dropoffs, probs in bucket_probs(
+                fn_probs, interval_min, interval_max, weekdays, bucket_size):
+            first = interval_min + bucket * bucket_size
+            last = min(first + bucket_size, interval_max + 1) - 1
+            fn_html = os.path.join(atlas_dir, MAP_ATLAS.format(
+                first=first, last=last, pickup=pickup))
+            yield fn_html, pickup, dropoffs, probs
+
+    pool = Pool(n_workers, initializer=init_atlas_worker,
+                initargs=(fn_stations,))
+    n_maps = 0
+    for _ in tqdm.tqdm(pool.imap_unordered(write_atlas_map, tasks(), 64),
+                       desc="Writing heatmaps"):
+        n_maps += 1
+    pool.close()
+    pool.join()
+    return n_maps
 
 
 def plot_cumulative_heatmap(probs, sts, fn_html):
@@ -145,8 +216,8 @@ if __name__ == "__main__":
         description="Plot the probability of a given requests.")
     parser.add_argument(
         "--fn_probs", dest="fn_probs", type=str,
-        default="data/probs.csv",
-        help="CSV of probabilities for given requests.")
+        default="data/probs.npy",
+        help="Table of probabilities for given requests.")
     parser.add_argument(
         "--interval_min", dest="interval_min", type=int, default=0,
         help="Minimum interval for the probability plot.")
@@ -172,9 +243,26 @@ if __name__ == "__main__":
     parser.add_argument(
         "--fn_dropoff_map", dest="fn_dropoff_map", type=str,
         default=MAP_DROPOFF_CUMULATIVE, help="Output file for dropofff HTML")
+    parser.add_argument(
+        "--atlas_dir", dest="atlas_dir", type=str, default=None,
+        help="If given, the dropoff heatmap of every pickup station and\
+        interval bucket is written to this directory")
+    parser.add_argument(
+        "--bucket_size", dest="bucket_size", type=int, default=4,
+        help="Number of intervals per heatmap of the atlas")
+    parser.add_argument(
+        "--n_workers", dest="n_workers", type=int, default=4,
+        help="Number of worker processes used to write the atlas")
     args = parser.parse_args()
-    sts = load_stations(args.fn_stations)
-    pp, dp = load_cumulative_probs(args.fn_probs, args.interval_min,
-                                   args.interval_max, args.weekdays)
-    plot_cumulative_heatmap(pp, sts, args.fn_pickup_map)
-    plot_cumulative_heatmap(dp, sts, args.fn_dropoff_map)
+    if args.atlas_dir is not None:
+        n_maps = plot_heatmap_atlas(
+            args.fn_probs, args.fn_stations, args.interval_min,
+            args.interval_max, args.weekdays, args.bucket_size,
+            args.atlas_dir, args.n_workers)
+        print "Heatmaps:", n_maps
+    else:
+        sts = load_stations(args.fn_stations)
+        pp, dp = load_cumulative_probs(args.fn_probs, args.interval_min,
+                                       args.interval_max, args.weekdays)
+        plot_cumulative_heatmap(pp, sts, args.fn_pickup_map)
+        plot_cumulative_heatmap(dp, sts, args.fn_dropoff_map)
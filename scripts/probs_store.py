@@ -0,0 +1,78 @@
+
+import os.path
+import numpy as np
+
+
+n_days = 7
+fn_index_template = "{}.index.npy"
+
+
+def index_path(fn_probs):
+    """
+    Returns the filename of the index kept next to a probabilities table
+    """
+    return fn_index_template.format(os.path.splitext(fn_probs)[0])
+
+
+def build_index(table, intervals_per_day, n_stations):
+    """
+    Given a probabilities table sorted by day, tau and pickup, this returns
+    the offsets of the rows of every (day, tau, pickup) key, so the rows of
+    key k are offsets[k] to offsets[k + 1]
+    """
+    keys = (table["day"].astype(np.int64) * intervals_per_day
+            + table["tau"]) * n_stations + table["pickup"]
+    n_keys = n_days * intervals_per_day * n_stations
+    return np.searchsorted(keys, np.arange(n_keys + 1))
+
+
+def save_index(fn_probs, table, intervals_per_day, n_stations):
+    np.save(index_path(fn_probs),
+            build_index(table, intervals_per_day, n_stations))
+
+
+class ProbsStore(object):
+    """
+    Memory mapped probabilities table along with its (day, tau, pickup)
+    index. Queries only touch the slices of the table they need
+    """
+
+    def __init__(self, fn_probs, intervals_per_day=96):
+        self.table = np.load(fn_probs, mmap_mode="r")
+        fn_index = index_path(fn_probs)
+        if not os.path.exists(fn_index):
+            n_stations = int(max(self.table["pickup"].max(),
+                                 self.table["dropoff"].max())) + 1
+            save_index(fn_probs, self.table, intervals_per_day, n_stations)
+        self.offsets = np.load(fn_index, mmap_mode="r")
+        self.intervals_per_day = intervals_per_day
+        self.n_stations = (self.offsets.shape[0] - 1) \
+            / (n_days * intervals_per_day)
+
+    def key(self, day, tau, pickup):
+        return (day * self.intervals_per_day + tau) * self.n_stations \
+            + pickup
+
+    def rows(self, interval_min, interval_max, weekdays, pickup=None):
+        """
+        Returns the rows within the interval range, both ends included, for
+        the given weekdays and, if given, pickup station
+        """
+        interval_max = min(interval_max, self.intervals_per_day - 1)
+        slices = list()
+        for day in np.atleast_1d(weekdays):
+            if pickup is None:
+                # All the pickups of the interval range are contiguous
+                bounds = [(self.key(day, interval_min, 0),
+                           self.key(day, interval_max + 1, 0))]
+            else:
+                bounds = [(self.key(day, tau, pickup),
+                           self.key(day, tau, pickup + 1))
+                          for tau in xrange(interval_min, interval_max + 1)]
+            for first, last in bounds:
+                start, end = self.offsets[first], self.offsets[last]
+                if end > start:
+                    slices.append(self.table[start:end])
+        if len(slices) == 0:
+            return self.table[:0]
+        return np.concatenate(slices)
@@ -0,0 +1,237 @@
+
+import os.path
+import numpy as np
+
+
+def count_indices(index):
+    """
+    Reduces an array of flat tensor indices to (index, count) pairs
+    """
+    return np.unique(index, return_counts=True)
+
+
+def merge_counts(indices, counts):
+    """
+    Merges lists of (index, count) arrays into a single pair of arrays with
+    sorted, unique indices
+    """
+    index = np.concatenate(indices)
+    uniq, inv = np.unique(index, return_inverse=True)
+    count = np.bincount(inv, weights=np.concatenate(counts),
+                        minlength=uniq.shape[0])
+    return uniq, count.astype(np.int64)
+
+
+class SparseFreqs(object):
+    """
+    Frequency tensor kept as (flat index, count) pairs. Added pairs are
+    buffered and only merged once they outgrow the merged pairs, so adding
+    many small chunks stays cheap
+    """
+
+    def __init__(self, shape, index=None, count=None):
+        self.shape = tuple(int(v) for v in shape)
+        if index is None:
+            index = np.zeros(0, dtype=np.int64)
+            count = np.zeros(0, dtype=np.int64)
+        self.index = np.asarray(index, dtype=np.int64)
+        self.count = np.asarray(count, dtype=np.int64)
+        self.pending = list()
+        self.n_pending = 0
+
+    def add(self, index, count):
+        self.pending.append((index, count))
+        self.n_pending += index.shape[0]
+        if self.n_pending > max(self.index.shape[0], 1000000):
+            self.compact()
+
+    def add_freqs(self, other):
+        self.add(*other.pairs())
+
+    def compact(self):
+        if len(self.pending) > 0:
+            indices = [self.index] + [p[0] for p in self.pending]
+            counts = [self.count] + [p[1] for p in self.pending]
+            self.index, self.count = merge_counts(indices, counts)
+            self.pending = list()
+            self.n_pending = 0
+
+    def pairs(self):
+        self.compact()
+        return self.index, self.count
+
+    def to_dense(self):
+        self.compact()
+        freqs = np.zeros(np.prod(self.shape), dtype=np.int64)
+        freqs[self.index] = self.count
+        return freqs.reshape(self.shape)
+
+    def save(self, fn_freqs):
+        self.compact()
+        with open(fn_freqs, "wb") as fout:
+            np.savez(fout, shape=self.shape, index=self.index,
+                     count=self.count)
+
+    @classmethod
+    def load(cls, fn_freqs):
+        data = np.load(fn_freqs)
+        return cls(data["shape"], data["index"], data["count"])
+
+
+def save_cumulative(freqs, fn_cum_freqs):
+    """
+    Saves the running total of a dense frequency tensor, taken over its
+    cells in C order, as a tensor of the same shape. Cells that are
+    contiguous in C order, like all the cells of an interval over a range of
+    days, then have their total as the difference of two entries and can be
+    sampled from with a binary search
+    """
+    cum_freqs = np.lib.format.open_memmap(
+        fn_cum_freqs, mode="w+", dtype=np.int64, shape=freqs.shape)
+    np.cumsum(freqs.reshape(-1), out=cum_freqs.reshape(-1))
+    cum_freqs.flush()
+
+
+def load_manifest(fn_manifest):
+    """
+    Returns the (partial, input) pairs listed in a manifest, one tab
+    separated pair per line
+    """
+    if not os.path.exists(fn_manifest):
+        return list()
+    entries = list()
+    with open(fn_manifest, "rb") as fin:
+        for line in fin:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0]:
+                entries.append((fields[0], fields[1] if len(fields) > 1
+                                else ""))
+    return entries
+
+
+def save_manifest(fn_manifest, entries):
+    """
+    Writes the manifest to a temporary file and renames it into place, so
+    it is either the old or the new list and never a partial one
+    """
+    with open(fn_manifest + ".tmp", "wb") as fout:
+        for fn_partial, fn_input in entries:
+            fout.write("{}\t{}\n".format(fn_partial, fn_input))
+    os.rename(fn_manifest + ".tmp", fn_manifest)
+
+
+def load_sparse_master(fn_freqs, shape):
+    """
+    Returns the master SparseFreqs and the (partial, input) pairs already
+    merged into it, which are saved inside the master file
+    """
+    if not os.path.exists(fn_freqs):
+        return SparseFreqs(shape), list()
+    with np.load(fn_freqs) as data:
+        master = SparseFreqs(data["shape"], data["index"], data["count"])
+        entries = list()
+        if "partials" in data.files:
+            entries = zip(data["partials"].tolist(), data["inputs"].tolist())
+    return master, entries
+
+
+def save_sparse_master(fn_freqs, master, entries):
+    """
+    Saves the master along with the pairs merged into it to a temporary
+    file and renames it into place, so the counts and the list of merged
+    partials always change together
+    """
+    master.compact()
+    fn_tmp = fn_freqs + ".tmp"
+    with open(fn_tmp, "wb") as fout:
+        np.savez(fout, shape=master.shape, index=master.index,
+                 count=master.count,
+                 partials=np.array([e[0] for e in entries], dtype=str),
+                 inputs=np.array([e[1] for e in entries], dtype=str))
+    os.rename(fn_tmp, fn_freqs)
+
+
+def journal_path(fn_freqs):
+    return fn_freqs + ".journal.npz"
+
+
+def undo_journal(flat, fn_journal, done):
+    """
+    Puts back the cells a crashed merge saved before adding a partial to a
+    dense master, unless the partial made it into the manifest
+    """
+    if not os.path.exists(fn_journal):
+        return
+    with np.load(fn_journal) as journal:
+        if str(journal["partial"]) not in done:
+            flat[journal["index"]] = journal["old"]
+    os.remove(fn_journal)
+
+
+def merge_partials(fn_freqs, shape, partials, fn_manifest, sparse=False):
+    """
+    Folds the (partial, input) pairs whose partial tensor is not merged yet
+    into the master tensor, which is created if it does not exist. A rerun
+    after a crash never adds a partial twice:
+
+    - if sparse is set, the master is a SparseFreqs .npz file that lists
+      the partials merged into it. Every merge writes a new master and
+      renames it into place. The manifest is then rewritten as a copy of
+      that list
+    - otherwise the master is a memory mapped .npy file updated in place
+      and the manifest is the list. The cells a partial touches are saved
+      to a journal before it is added, and the manifest is renamed into
+      place once the master is flushed. A rerun puts the journaled cells
+      back if the manifest does not list their partial
+
+    Returns the partials that were merged
+    """
+    shape = tuple(int(v) for v in shape)
+    partials = [(os.path.abspath(fn_partial), fn_input)
+                for fn_partial, fn_input in partials]
+    if sparse:
+        master, entries = load_sparse_master(fn_freqs, shape)
+        master_shape = master.shape
+    else:
+        entries = load_manifest(fn_manifest)
+        if os.path.exists(fn_freqs):
+            master = np.load(fn_freqs, mmap_mode="r+")
+        else:
+            master = np.lib.format.open_memmap(
+                fn_freqs, mode="w+", dtype=np.int64, shape=shape)
+        master_shape = master.shape
+    if master_shape != shape:
+        raise ValueError("Master tensor {} has shape {}, expected {}"
+                         .format(fn_freqs, master_shape, shape))
+    done = set(fn_partial for fn_partial, _ in entries)
+    if not sparse:
+        flat = master.reshape(-1)
+        undo_journal(flat, journal_path(fn_freqs), done)
+        master.flush()
+    todo = list()
+    for fn_partial, fn_input in partials:
+        if fn_partial in done:
+            continue
+        partial = SparseFreqs.load(fn_partial)
+        if partial.shape != shape:
+            raise ValueError("Partial tensor {} has shape {}, expected {}"
+                             .format(fn_partial, partial.shape, shape))
+        entries.append((fn_partial, fn_input))
+        if sparse:
+            master.add_freqs(partial)
+            save_sparse_master(fn_freqs, master, entries)
+        else:
+            fn_journal = journal_path(fn_freqs)
+            with open(fn_journal + ".tmp", "wb") as fout:
+                np.savez(fout, partial=fn_partial, index=partial.index,
+                         old=flat[partial.index])
+            os.rename(fn_journal + ".tmp", fn_journal)
+            flat[partial.index] += partial.count
+            master.flush()
+            save_manifest(fn_manifest, entries)
+            os.remove(fn_journal)
+        done.add(fn_partial)
+        todo.append(fn_partial)
+    if sparse:
+        save_manifest(fn_manifest, entries)
+    return todo
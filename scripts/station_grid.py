@@ -0,0 +1,147 @@
+
+import os.path
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+fn_grid_template = "{}.grid.npz"
+default_cell_size = 0.001
+grid_padding = 2
+
+
+def grid_path(fn_stations):
+    """
+    Returns the filename of the grid index kept next to a stations file
+    """
+    return fn_grid_template.format(os.path.splitext(fn_stations)[0])
+
+
+class StationGrid(object):
+    """
+    Uniform lon/lat grid over a set of stations. Every cell holds the
+    stations that can be the closest one to some point in the cell, so
+    snapping a point is a cell lookup followed by a search over a handful
+    of candidates. Points outside of the grid fall back to a KD-tree
+    """
+
+    def __init__(self, coords, origin, cell_size, shape, cells):
+        self.coords = np.asarray(coords, dtype=np.float64)
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.cell_size = float(cell_size)
+        self.shape = tuple(int(v) for v in shape)
+        self.cells = np.asarray(cells, dtype=np.int32)
+        self.tree = None
+
+    @classmethod
+    def build(cls, coords, cell_size=default_cell_size):
+        coords = np.asarray(coords, dtype=np.float64)
+        origin = coords.min(axis=0) - grid_padding * cell_size
+        extent = coords.max(axis=0) + grid_padding * cell_size - origin
+        shape = np.ceil(extent / cell_size).astype(int) + 1
+        xs, ys = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]),
+                             indexing="ij")
+        centers = origin + (np.column_stack((xs.ravel(), ys.ravel())) + 0.5) \
+            * cell_size
+        # Any point of a cell is within the half diagonal of its center, so
+        # its closest station is within the distance from the center to the
+        # closest station plus a full diagonal of the center
+        diag = np.sqrt(2) * cell_size
+        tree = cKDTree(coords)
+        dists, _ = tree.query(centers)
+        cands = [tree.query_ball_point(center, radius)
+                 for center, radius in zip(centers, dists + diag)]
+        width = max(len(c) for c in cands)
+        cells = -np.ones((len(cands), width), dtype=np.int32)
+        for i, cand in enumerate(cands):
+            cells[i, :len(cand)] = cand
+        grid = cls(coords, origin, cell_size, shape, cells)
+        grid.tree = tree
+        return grid
+
+    @classmethod
+    def load(cls, fn_grid):
+        data = np.load(fn_grid)
+        return cls(data["coords"], data["origin"], data["cell_size"],
+                   data["shape"], data["cells"])
+
+    def save(self, fn_grid):
+        with open(fn_grid, "wb") as fout:
+            np.savez(fout, coords=self.coords, origin=self.origin,
+                     cell_size=self.cell_size, shape=self.shape,
+                     cells=self.cells)
+
+    def query(self, points, n_jobs=1):
+        """
+        Same interface as cKDTree.query for k = 1. Returns the distances to
+        and the labels of the closest stations to an (n, 2) array of points
+        """
+        points = np.asarray(points, dtype=np.float64)
+        ij = np.floor((points - self.origin) / self.cell_size).astype(int)
+        inside = np.all((ij >= 0) & (ij < self.shape), axis=1)
+        dists = np.empty(points.shape[0])
+        labels = np.empty(points.shape[0], dtype=np.int64)
+        if inside.any():
+            pts = points[inside]
+            cands = self.cells[np.ravel_multi_index(ij[inside].T, self.shape)]
+            best = np.full(pts.shape[0], np.inf)
+            best_labels = cands[:, 0].astype(np.int64)
+            # Most cells only have a few candidates, so only the points whose
+            # cell has a k-th candidate are looked at in the k-th round
+            todo = np.arange(pts.shape[0])
+            for k in xrange(cands.shape[1]):
+                todo = todo[cands[todo, k] >= 0]
+                if todo.shape[0] == 0:
+                    break
+                c = cands[todo, k]
+                d = ((self.coords[c] - pts[todo]) ** 2).sum(axis=1)
+                closer = d < best[todo]
+                best[todo[closer]] = d[closer]
+                best_labels[todo[closer]] = c[closer]
+            dists[inside] = np.sqrt(best)
+            labels[inside] = best_labels
+        if not inside.all():
+            if self.tree is None:
+                self.tree = cKDTree(self.coords)
+            o_dists, o_labels = self.tree.query(points[~inside],
+                                                n_jobs=n_jobs)
+            dists[~inside] = o_dists
+            labels[~inside] = o_labels
+        return dists, labels
+
+
+def load_station_grid(fn_stations, coords, cell_size=default_cell_size):
+    """
+    Loads the grid index persisted next to the stations file. The index is
+    built and saved if it does not exist yet or was built for other stations
+    """
+    fn_grid = grid_path(fn_stations)
+    if os.path.exists(fn_grid):
+        grid = StationGrid.load(fn_grid)
+        if np.array_equal(grid.coords, coords):
+            return grid
+    grid = StationGrid.build(coords, cell_size)
+    grid.save(fn_grid)
+    return grid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Builds the grid index used to snap coordinates to the\
+        closest station")
+    parser.add_argument(
+        "--fn_stations", dest="fn_stations", type=str,
+        default="data/stations-mod.csv",
+        help="Stations with id,lng,lat columns")
+    parser.add_argument(
+        "--cell_size", dest="cell_size", type=float,
+        default=default_cell_size,
+        help="Width of a cell of the grid in degrees")
+    args = parser.parse_args()
+    stations = pd.read_csv(args.fn_stations)
+    grid = StationGrid.build(stations.as_matrix(["lng", "lat"]),
+                             args.cell_size)
+    grid.save(grid_path(args.fn_stations))
+    print "Cells:", grid.cells.shape[0], "Max candidates:", \
+        grid.cells.shape[1]
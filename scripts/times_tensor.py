@@ -0,0 +1,122 @@
+
+import os
+import argparse
+import numpy as np
+import graph_engine
+
+
+secs_per_hour = 60 * 60
+hours_per_day = graph_engine.hours_per_day
+
+
+def write_times_tensor(fn_tensor, nyc_dir, fn_edge_times, n_workers=1):
+    """
+    Saves the travel times between all pairs of nodes for every hour of the
+    day as a memory mapped (hour, n, n) float32 .npy tensor over the
+    original node ids, with -1 for the pairs that are not connected. Every
+    hour starts from the shortest paths of the hour before it. Returns the
+    tensor, memory mapped read-only
+    """
+    dirname = os.path.dirname(fn_tensor)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    graph, _ = graph_engine.load_road_graph(nyc_dir)
+    edge_times = graph_engine.load_edge_times(fn_edge_times)
+    n = graph.n_nodes
+    tensor = np.lib.format.open_memmap(fn_tensor, mode="w+",
+                                       dtype=np.float32,
+                                       shape=(hours_per_day, n, n))
+    base = os.path.splitext(fn_tensor)[0]
+    fn_times = base + ".hour_times.npy"
+    fn_preds = base + ".hour_preds.npy"
+    prev_weights = None
+    for hour in xrange(hours_per_day):
+        print "Hour {}/{}".format(hour + 1, hours_per_day)
+        weights = graph_engine.hour_weights(edge_times, hour)
+        if prev_weights is None:
+            times, _ = graph_engine.all_pairs(graph, weights, fn_times,
+                                              fn_preds, n_workers)
+        else:
+            times, _, _ = graph_engine.update_pairs(
+                graph, prev_weights, weights, fn_times, fn_preds, fn_times,
+                fn_preds, n_workers)
+        tensor[hour] = times
+        del times
+        prev_weights = weights
+    tensor.flush()
+    del tensor
+    os.remove(fn_times)
+    os.remove(fn_preds)
+    return np.load(fn_tensor, mmap_mode="r")
+
+
+def interp_hours(secs):
+    """
+    Returns the two hours to interpolate between for a time of day in
+    seconds and the weight of the second one. The times of an hour hold in
+    its middle, so 8:30 gives hour 8 alone and 23:45 mixes hours 23 and 0
+    """
+    pos = (np.asarray(secs, dtype=np.float64) / secs_per_hour - 0.5) \
+        % hours_per_day
+    first = np.floor(pos).astype(np.int64)
+    return first, (first + 1) % hours_per_day, pos - first
+
+
+class TimesTensor(object):
+    """
+    Memory mapped (hour, n, n) travel times tensor written by
+    write_times_tensor, queried at any time of day in seconds by
+    interpolating between the hours around it. Pairs that are not connected
+    give -1
+    """
+
+    def __init__(self, fn_tensor):
+        self.tensor = np.load(fn_tensor, mmap_mode="r")
+        self.n_hours, self.n_nodes, _ = self.tensor.shape
+
+    def hour(self, hour):
+        """
+        Returns the (n, n) travel times matrix of an hour
+        """
+        return self.tensor[hour]
+
+    def times(self, origins, destinations, secs):
+        """
+        Returns the travel times of the origin and destination pairs at the
+        given times of day, broadcasting them against each other
+        """
+        origins, destinations, secs = np.broadcast_arrays(
+            origins, destinations, secs)
+        first, second, weight = interp_hours(secs)
+        before = self.tensor[first, origins, destinations]
+        after = self.tensor[second, origins, destinations]
+        times = (1 - weight) * before + weight * after
+        return np.where((before < 0) | (after < 0), -1, times)
+
+    def time(self, origin, destination, secs):
+        return float(self.times(origin, destination, secs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Creates a tensor of the travel times between all the\
+        nodes of the graph for every hour of the day")
+    parser.add_argument(
+        "--nyc_dir", dest="nyc_dir", type=str,
+        default="data/nyc-graph/",
+        help="Directory for the NYC graph data")
+    parser.add_argument(
+        "--fn_edge_times", dest="fn_edge_times", type=str,
+        default="week.csv",
+        help="CSV file with the edge times per hour")
+    parser.add_argument(
+        "--fn_tensor", dest="fn_tensor", type=str,
+        default="data/times_tensor.npy",
+        help="Output .npy tensor of the travel times of every hour")
+    parser.add_argument(
+        "--n_workers", dest="n_workers", type=int, default=1,
+        help="Number of processes the sources of the shortest paths are\
+        split over")
+    args = parser.parse_args()
+    write_times_tensor(args.fn_tensor, args.nyc_dir, args.fn_edge_times,
+                       args.n_workers)
@@ -0,0 +1,193 @@
+
+import io
+import os
+import os.path
+import argparse
+import numpy as np
+import pandas as pd
+import tqdm
+import common
+from collections import OrderedDict
+
+
+interval_length = 15
+
+store_dtypes = OrderedDict([
+    ("pickup_epoch", np.int64),
+    ("dropoff_epoch", np.int64),
+    ("pickup_day", np.int32),
+    ("weekday", np.int8),
+    ("interval", np.int16),
+    ("pickup_longitude", np.float64),
+    ("pickup_latitude", np.float64),
+    ("dropoff_longitude", np.float64),
+    ("dropoff_latitude", np.float64),
+    ("passenger_count", np.int16),
+])
+
+fn_column_template = "{}.npy"
+day_order_name = "day_order"
+fn_partial_template = "{}.bin"
+
+csv_fields = ["pickup_datetime", "dropoff_datetime", "passenger_count",
+              "pickup_longitude", "pickup_latitude", "dropoff_longitude",
+              "dropoff_latitude"]
+
+
+def column_path(store_dir, name):
+    return os.path.join(store_dir, fn_column_template.format(name))
+
+
+def convert_chunk(df):
+    """
+    Turns a chunk of the cleaned CSV into a dict of typed columns. The
+    pickup day is counted in days since 1970-01-01 and the interval is the
+    15 minute interval of the day the pickup falls in
+    """
+    p_dec = common.decode_datetimes(df["pickup_datetime"].values,
+                                    interval_length)
+    d_dec = common.decode_datetimes(df["dropoff_datetime"].values,
+                                    interval_length)
+    cols = dict()
+    cols["pickup_epoch"] = p_dec["epoch"]
+    cols["dropoff_epoch"] = d_dec["epoch"]
+    cols["pickup_day"] = p_dec["day"]
+    cols["weekday"] = p_dec["weekday"]
+    cols["interval"] = p_dec["interval"]
+    for field in csv_fields[2:]:
+        cols[field] = df[field].values
+    return cols
+
+
+def iter_csv_trips(fn_cleaned, chunksize=1000000):
+    """
+    Yields the cleaned CSV as dicts of typed columns, a chunk at a time. The
+    columns are picked by position, so the header pins the number of fields
+    and rows with extra fields at the end keep their columns
+    """
+    cols = sorted(common.fn_raw_fields.index(field) for field in csv_fields)
+    dfs = pd.read_csv(fn_cleaned, header=0, usecols=cols, index_col=False,
+                      chunksize=chunksize)
+    for df in dfs:
+        df.columns = [common.fn_raw_fields[i] for i in cols]
+        yield convert_chunk(df)
+
+
+def iter_store_trips(store, chunksize=1000000):
+    """
+    Yields the rows of a store as dicts of columns, a chunk at a time
+    """
+    for start, end in store_chunks(store_length(store), chunksize):
+        yield store_slice(store, start, end)
+
+
+def write_columns(cols, store_dir):
+    """
+    Writes a dict of full length columns to the store, replacing any columns
+    with the same names
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    for name, dtype in store_dtypes.items():
+        np.save(column_path(store_dir, name),
+                np.asarray(cols[name], dtype=dtype))
+
+
+def write_trip_store(fn_cleaned, store_dir, chunksize=1000000):
+    """
+    Converts the cleaned CSV into a store of one .npy file per column. The
+    CSV is parsed in chunks and each chunk is appended to raw partial files,
+    which are copied into the final .npy files once the length is known.
+    Returns the number of trips in the store
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    partials = OrderedDict()
+    for name in store_dtypes.keys():
+        fn_partial = os.path.join(store_dir, fn_partial_template.format(name))
+        partials[name] = io.open(fn_partial, "wb")
+    n_trips = 0
+    for cols in tqdm.tqdm(iter_csv_trips(fn_cleaned, chunksize),
+                          desc="Converting trips"):
+        for name, dtype in store_dtypes.items():
+            cols[name].astype(dtype).tofile(partials[name])
+        n_trips += cols["pickup_day"].shape[0]
+    for name, dtype in store_dtypes.items():
+        partials[name].close()
+        fn_partial = partials[name].name
+        out = np.lib.format.open_memmap(column_path(store_dir, name),
+                                        mode="w+", dtype=dtype,
+                                        shape=(n_trips,))
+        if n_trips > 0:
+            out[:] = np.memmap(fn_partial, dtype=dtype, mode="r")
+        out.flush()
+        del out
+        os.remove(fn_partial)
+    return n_trips
+
+
+def load_trip_store(store_dir, columns=None):
+    """
+    Memory maps the columns of a store. Returns a dict from column name to
+    a read-only array
+    """
+    if columns is None:
+        columns = store_dtypes.keys()
+    store = dict()
+    for name in columns:
+        store[name] = np.load(column_path(store_dir, name), mmap_mode="r")
+    return store
+
+
+def write_day_order(store_dir):
+    """
+    Saves the row numbers of the store ordered by pickup day, keeping the
+    original order within a day, next to the columns. Returns the days along
+    with the (start, end) range of the ordered rows of every day
+    """
+    days = np.load(column_path(store_dir, "pickup_day"), mmap_mode="r")
+    order = np.argsort(days, kind="mergesort")
+    np.save(column_path(store_dir, day_order_name), order)
+    uniq, starts = np.unique(days[order], return_index=True)
+    ends = np.append(starts[1:], order.shape[0])
+    return uniq, zip(starts, ends)
+
+
+def load_day_order(store_dir):
+    return np.load(column_path(store_dir, day_order_name), mmap_mode="r")
+
+
+def store_length(store):
+    return next(iter(store.values())).shape[0]
+
+
+def store_slice(store, start, end):
+    """
+    Returns a dict with the rows start to end of every column in the store
+    """
+    return dict((name, col[start:end]) for name, col in store.items())
+
+
+def store_chunks(n_trips, chunksize):
+    """
+    Splits the rows of a store into (start, end) ranges of chunksize rows
+    """
+    return [(start, min(start + chunksize, n_trips))
+            for start in xrange(0, n_trips, chunksize)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts the cleaned taxi data into a columnar store of\
+        memory mappable .npy files")
+    parser.add_argument(
+        "--fn_cleaned", dest="fn_cleaned", type=str,
+        default="data/trip_data_short_cleaned.csv",
+        help="Cleaned data to convert")
+    parser.add_argument(
+        "--store_dir", dest="store_dir", type=str,
+        default="data/trip_store/",
+        help="Output directory for the columns of the store")
+    args = parser.parse_args()
+    n_trips = write_trip_store(args.fn_cleaned, args.store_dir)
+    print "Trips:", n_trips
@@ -0,0 +1,87 @@
+import io
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import common
+import trip_store
+
+
+def load_block(fn_cleaned, n_rows):
+    """
+    Returns the stripped header names and the first n_rows lines of the
+    cleaned CSV
+    """
+    with io.open(fn_cleaned, "rb") as fin:
+        names = [f.strip() for f in fin.readline().strip().split(",")]
+        lines = list()
+        for line in fin:
+            if len(lines) == n_rows:
+                break
+            lines.append(line.rstrip("\r\n"))
+    return names, lines
+
+
+def store_columns(fn_cleaned):
+    chunks = list(trip_store.iter_csv_trips(fn_cleaned))
+    return {k: np.concatenate([c[k] for c in chunks]) for k in chunks[0]}
+
+
+def check_chunks(fn_cleaned, n_rows=1000):
+    """
+    Checks that a block of the cleaned CSV that starts on a row with extra
+    fields at the end parses the same as it does without them, both as a
+    compute_probs byte range and through trip_store.iter_csv_trips. Returns
+    the names of the checks that failed
+    """
+    names, lines = load_block(fn_cleaned, n_rows)
+    extra = [lines[0] + ",extra,x"] + lines[1:]
+    failed = list()
+    ref = pd.read_csv(io.BytesIO("\n".join(lines) + "\n"), header=None,
+                      names=names)
+    try:
+        ok = common.read_csv_block("\n".join(lines) + "\n", names)
+        bad = common.read_csv_block("\n".join(extra) + "\n", names)
+        if not (ok.equals(bad) and np.array_equal(
+                ok["pickup_longitude"].values,
+                ref["pickup_longitude"].values)):
+            failed.append("read_csv_block")
+    except ValueError:
+        failed.append("read_csv_block")
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        header = ",".join(names)
+        for name, block in [("ok.csv", lines), ("extra.csv", extra)]:
+            with io.open(os.path.join(tmp_dir, name), "wb") as fout:
+                fout.write("\n".join([header] + block) + "\n")
+        ok = store_columns(os.path.join(tmp_dir, "ok.csv"))
+        bad = store_columns(os.path.join(tmp_dir, "extra.csv"))
+        if any(not np.array_equal(ok[k], bad[k]) for k in ok):
+            failed.append("iter_csv_trips")
+    except ValueError:
+        failed.append("iter_csv_trips")
+    finally:
+        shutil.rmtree(tmp_dir)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Checks that chunks of the cleaned data starting on rows\
+        with extra fields are parsed like any other chunk")
+    parser.add_argument(
+        "--fn_cleaned", dest="fn_cleaned", type=str,
+        default="data/trip_data_short_cleaned.csv",
+        help="Cleaned data to take the rows from")
+    parser.add_argument(
+        "--n_rows", dest="n_rows", type=int, default=1000,
+        help="Number of rows in the checked chunk")
+    args = parser.parse_args()
+    failed = check_chunks(args.fn_cleaned, args.n_rows)
+    if len(failed) > 0:
+        print "Failed:", ", ".join(failed)
+        sys.exit(1)
+    print "OK"
@@ -1,4 +1,6 @@
 
+import argparse
+import graph_engine
 import numpy as np
 from progressbar import ProgressBar, ETA, Percentage, Bar
 import pickle
@@ -10,7 +12,7 @@ def load_path(path_str):
 
 
 def check_times(fn_times, fn_paths):
-    times = np.loadtxt(fn_times, skiprows=1)
+    times = graph_engine.load_times(fn_times)
     pbar = ProgressBar(
         widgets=["Debugging Paths File: ", Bar(), Percentage(), "|", ETA()],
         maxval=pow(times.shape[0], 2)).start()
@@ -42,4 +44,13 @@ def check_times(fn_times, fn_paths):
 
 
 if __name__ == "__main__":
-    check_times("data/times.csv", "data/paths.csv")
+    parser = argparse.ArgumentParser(
+        description="Checks that the travel times add up along the paths")
+    parser.add_argument(
+        "--fn_times", dest="fn_times", type=str, default="data/times.csv",
+        help="Travel times, either a times.csv file or a .npy matrix")
+    parser.add_argument(
+        "--fn_paths", dest="fn_paths", type=str, default="data/paths.csv",
+        help="All pairs paths file")
+    args = parser.parse_args()
+    check_times(args.fn_times, args.fn_paths)